@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Time of the per-job lookups done by the stage scripts (a mutable per job,
+# and a json file per result) made one at a time through the blocking client,
+# compared with the pipelined AsyncKacheryClient. The daemon is replaced by a
+# local HTTP server, run in a separate process, that waits for the given
+# latency before answering each request. The client makes a new HTTP request
+# for every call.
+
+import os
+import sys
+import json
+import time
+import click
+import threading
+import urllib.request
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, f'{os.path.dirname(os.path.abspath(__file__))}/../../scripts')
+from async_kachery import AsyncKacheryClient
+
+class _StandInServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+def _run_stand_in_daemon(latency_sec: float, port_queue):
+    num_requests = [0]
+    lock = threading.Lock()
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path == '/num_requests':
+                response = {'value': num_requests[0]}
+            else:
+                with lock:
+                    num_requests[0] += 1
+                time.sleep(latency_sec)
+                if self.path == '/get':
+                    response = {'value': {'key': body['key']}}
+                elif self.path == '/load_json':
+                    response = {'value': {'uri': body['uri']}}
+                else:
+                    response = {'value': None}
+            data = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        def log_message(self, format, *args):
+            pass
+    server = _StandInServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+class StandInClient:
+    def __init__(self, url: str) -> None:
+        self._url = url
+    def get(self, key):
+        return self._request('/get', {'key': key})
+    def delete(self, key):
+        self._request('/delete', {'key': key})
+    def load_json(self, uri: str):
+        return self._request('/load_json', {'uri': uri})
+    @property
+    def num_requests(self) -> int:
+        return self._request('/num_requests', {})
+    def _request(self, path: str, body: dict):
+        req = urllib.request.Request(f'{self._url}{path}', data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read())['value']
+
+@click.command()
+@click.option('--num-jobs', default=500, help='Number of job keys looked up')
+@click.option('--latency-ms', default=5., help='Latency of each request to the stand-in daemon')
+@click.option('--max-concurrency', default=16, help='Maximum number of requests in flight')
+def main(num_jobs: int, latency_ms: float, max_concurrency: int):
+    keys = [{'type': 'sorting', 'kwargs': {'index': i}} for i in range(num_jobs)]
+    # results share a few sorting true metrics files
+    uris = [f'sha1://{i % 50:040d}/metrics.json' for i in range(num_jobs)]
+
+    port_queue = multiprocessing.Queue()
+    daemon = multiprocessing.Process(target=_run_stand_in_daemon, args=(latency_ms / 1000, port_queue), daemon=True)
+    daemon.start()
+    try:
+        client = StandInClient(f'http://127.0.0.1:{port_queue.get(timeout=10)}')
+
+        num_requests = client.num_requests
+        timer = time.time()
+        outputs_blocking = [client.get(key) for key in keys]
+        jsons_blocking = [client.load_json(uri) for uri in uris]
+        elapsed_blocking = time.time() - timer
+        print(f'Blocking: {elapsed_blocking:.2f} s ({client.num_requests - num_requests} requests)')
+
+        async_client = AsyncKacheryClient(client=client, max_concurrency=max_concurrency)
+        num_requests = client.num_requests
+        timer = time.time()
+        outputs = async_client.get_many(keys)
+        jsons = async_client.load_json_many(uris)
+        elapsed_async = time.time() - timer
+        print(f'Async, max concurrency {max_concurrency}: {elapsed_async:.2f} s ({client.num_requests - num_requests} requests)')
+        assert outputs == outputs_blocking and jsons == jsons_blocking, 'Unexpected: results differ'
+
+        num_requests = client.num_requests
+        timer = time.time()
+        async_client.load_json_many(uris)
+        print(f'Async, json again (cached): {time.time() - timer:.3f} s ({client.num_requests - num_requests} requests)')
+        print(f'Speedup: {elapsed_blocking / elapsed_async:.1f}x')
+    finally:
+        daemon.terminate()
+        daemon.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Startup time of the spikeforest CLI for cheap invocations, compared with
+# the cost of importing the heavy dependencies that every stage script
+# used to import at module level.
+
+import os
+import sys
+import time
+import subprocess
+import click
+
+scripts_dir = f'{os.path.dirname(os.path.abspath(__file__))}/../../scripts'
+cli = f'{scripts_dir}/spikeforest.py'
+
+def _time_command(args: list, num_repeats: int):
+    elapsed = []
+    for _ in range(num_repeats):
+        timer = time.time()
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        elapsed.append(time.time() - timer)
+    elapsed.sort()
+    return elapsed[len(elapsed) // 2]
+
+@click.command()
+@click.option('--num-repeats', default=5, help='Number of runs of each command (the median is reported)')
+def main(num_repeats: int):
+    commands = [
+        ('python (no imports)', [sys.executable, '-c', 'pass']),
+        ('spikeforest.py --help', [sys.executable, cli, '--help']),
+        ('spikeforest.py sorting --help', [sys.executable, cli, 'sorting', '--help']),
+        ('spikeforest.py prepare-recording-nwb --help', [sys.executable, cli, 'prepare-recording-nwb', '--help']),
+        ('spikeforest.py print-results --help', [sys.executable, cli, 'print-results', '--help']),
+        ('import heavy dependencies', [sys.executable, '-c', 'import spikeinterface.extractors, spikeinterface.toolkit, sortingview, nwb_conversion_tools, runarepo, figurl'])
+    ]
+    for label, args in commands:
+        elapsed = _time_command(args, num_repeats=num_repeats)
+        print(f'{label}: {elapsed * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    main()
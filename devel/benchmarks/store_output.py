@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Compare storing a large synthetic recording.nwb with kc.store_file (write
+# to a temporary directory, then copy into kachery storage) against
+# output_store.store_output_file (write next to kachery storage, then
+# hardlink into place).
+#
+# Requires a running kachery daemon and KACHERY_STORAGE_DIR pointing to its
+# storage directory. Each run stores new random content.
+
+import os
+import sys
+import time
+import shutil
+import click
+import numpy as np
+import kachery_client as kc
+
+sys.path.insert(0, f'{os.path.dirname(os.path.abspath(__file__))}/../../scripts')
+from output_store import output_directory, get_output_scratch_dir, store_output_file
+
+def _write_synthetic_nwb(path: str, duration_sec: float, num_channels: int):
+    import spikeinterface as si
+    from nwb_conversion_tools.utils.spike_interface import write_recording
+    sampling_frequency = 30000.
+    num_frames = int(duration_sec * sampling_frequency)
+    traces = np.random.randn(num_frames, num_channels).astype(np.float32)
+    recording = si.NumpyRecording(traces_list=[traces], sampling_frequency=sampling_frequency)
+    write_recording(recording, save_path=path, compression=None, compression_opts=None)
+
+def _used_bytes(path: str):
+    return shutil.disk_usage(path).used
+
+def _run(label: str, tmpdir_context, store, storage_dir: str, duration_sec: float, num_channels: int):
+    used0 = _used_bytes(storage_dir)
+    timer = time.time()
+    with tmpdir_context() as tmpdir:
+        path = f'{tmpdir}/recording.nwb'
+        _write_synthetic_nwb(path, duration_sec=duration_sec, num_channels=num_channels)
+        file_size = os.path.getsize(path)
+        elapsed_write = time.time() - timer
+        uri = store(path)
+        elapsed_total = time.time() - timer
+        used_peak = _used_bytes(storage_dir) - used0
+    used_final = _used_bytes(storage_dir) - used0
+    print(f'{label}: {uri}')
+    print(f'    file size: {file_size / 1e9:.3f} GB')
+    print(f'    storage filesystem growth while storing: {used_peak / 1e9:.3f} GB (after cleanup: {used_final / 1e9:.3f} GB)')
+    print(f'    elapsed: write {elapsed_write:.2f} s, store {elapsed_total - elapsed_write:.2f} s, total {elapsed_total:.2f} s')
+
+@click.command()
+@click.option('--duration-sec', default=600., help='Duration of the synthetic recording')
+@click.option('--num-channels', default=32, help='Number of channels in the synthetic recording')
+def main(duration_sec: float, num_channels: int):
+    scratch_dir = get_output_scratch_dir()
+    if scratch_dir is None:
+        raise Exception('KACHERY_STORAGE_DIR must be set to the kachery storage directory')
+    storage_dir = os.environ['KACHERY_STORAGE_DIR']
+    _run('before (kc.TemporaryDirectory + kc.store_file)', kc.TemporaryDirectory, kc.store_file, storage_dir, duration_sec, num_channels)
+    _run('after (output_directory + store_output_file)', output_directory, store_output_file, storage_dir, duration_sec, num_channels)
+
+if __name__ == '__main__':
+    main()
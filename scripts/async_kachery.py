@@ -0,0 +1,100 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple, Union
+import kachery_client as kc
+
+# Asyncio wrapper around the blocking kachery client calls. Calls are run in a
+# thread pool of max_concurrency threads, so that up to that many requests are
+# in flight to the daemon at once rather than one after another. Content
+# addressed by sha1:// URIs never changes, so concurrent requests for it share
+# one call and it is kept in an in-process cache for cache_ttl_sec. Cached
+# objects are shared between callers and must not be modified.
+#
+# The *_many methods are blocking and are meant for scripts that are not
+# otherwise async:
+#
+#     outputs = get_async_client().get_many([job.key() for job in jobs])
+
+class AsyncKacheryClient:
+    def __init__(self, client=kc, max_concurrency: int=16, cache_ttl_sec: float=600) -> None:
+        self._client = client
+        self._max_concurrency = max_concurrency
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._cache_ttl_sec = cache_ttl_sec
+        self._cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._cache_lock = threading.Lock()
+        self._in_flight: Dict[tuple, asyncio.Future] = {}
+    async def get(self, key: Union[str, dict]):
+        return await self._call(self._client.get, key)
+    async def set(self, key: Union[str, dict], value: Any):
+        return await self._call(self._client.set, key, value)
+    async def delete(self, key: Union[str, dict]):
+        return await self._call(self._client.delete, key)
+    async def load_json(self, uri: str):
+        return await self._cached('load_json', uri, self._client.load_json)
+    async def load_file(self, uri: str):
+        return await self._cached('load_file', uri, self._client.load_file)
+    def get_many(self, keys: List[Union[str, dict]]) -> List[Any]:
+        return self._run_many(self.get, keys)
+    def delete_many(self, keys: List[Union[str, dict]]):
+        self._run_many(self.delete, keys)
+    def load_json_many(self, uris: List[str]) -> List[Any]:
+        return self._run_many(self.load_json, uris)
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache = {}
+    def _run_many(self, method, args: list):
+        if len(args) == 0:
+            return []
+        async def _gather():
+            return await asyncio.gather(*[method(a) for a in args])
+        try:
+            return list(asyncio.run(_gather()))
+        finally:
+            # no idle threads are left behind (e.g. when a process pool is forked next)
+            self.shutdown()
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+    async def _call(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(*args))
+    async def _cached(self, kind: str, uri: str, func):
+        if not uri.startswith('sha1://'):
+            return await self._call(func, uri)
+        with self._cache_lock:
+            x = self._cache.get((kind, uri), None)
+        if x is not None and x[0] > time.time():
+            return x[1]
+        # concurrent requests for the same content share one call
+        in_flight_key = (asyncio.get_running_loop(), kind, uri)
+        with self._cache_lock:
+            future = self._in_flight.get(in_flight_key, None)
+            owner = future is None
+            if owner:
+                future = asyncio.ensure_future(self._call(func, uri))
+                self._in_flight[in_flight_key] = future
+        try:
+            value = await future
+        finally:
+            if owner:
+                with self._cache_lock:
+                    self._in_flight.pop(in_flight_key, None)
+        # a missing file may show up later
+        if value is not None:
+            with self._cache_lock:
+                self._cache[(kind, uri)] = (time.time() + self._cache_ttl_sec, value)
+        return value
+
+_client: Union[AsyncKacheryClient, None] = None
+
+def get_async_client() -> AsyncKacheryClient:
+    global _client
+    if _client is None:
+        _client = AsyncKacheryClient()
+    return _client
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import click
+import yaml
+import numpy as np
+from typing import List
+import kachery_client as kc
+from Job import Job
+from async_kachery import get_async_client
+from workflow_lists import load_workflow_jobs
+from job_stats import record_job_stats
+from output_store import store_output_file
+from scratch import get_scratch_manager, scratch_directory
+from spike_trains import SpikeTrains, load_spike_trains
+
+def compute_agreement_matrix(spike_trains_list: List[SpikeTrains], delta_frames: int):
+    # Merge the time-sorted spike streams of all sortings, with units numbered
+    # globally, and find the pairs of spikes from different sortings within
+    # delta_frames by sweeping over lags in the merged stream. Since the
+    # merged times are sorted, once no pair at lag k is within delta_frames,
+    # none at a larger lag is either. Spikes are then matched one-to-one: a
+    # pair counts as a match if each spike is the nearest spike of the
+    # other's unit (ties go to the earlier spike), so that duplicate spikes a
+    # few samples apart are not counted twice.
+    unit_offsets = np.cumsum([0] + [len(st.unit_ids) for st in spike_trains_list])
+    num_units = int(unit_offsets[-1])
+    times = np.concatenate([np.asarray(st.spike_times) for st in spike_trains_list]).astype(np.int64)
+    labels = np.concatenate([np.asarray(st.spike_labels, dtype=np.int64) + unit_offsets[i] for i, st in enumerate(spike_trains_list)])
+    sorting_indices = np.concatenate([np.full(st.num_spikes, i, dtype=np.int32) for i, st in enumerate(spike_trains_list)])
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    labels = labels[order]
+    sorting_indices = sorting_indices[order]
+    num_spikes = len(times)
+
+    unit_spike_counts = np.bincount(labels, minlength=num_units).astype(np.int64)
+    # candidate pairs in both directions: (spike, other spike)
+    pairs_i: List[np.ndarray] = []
+    pairs_j: List[np.ndarray] = []
+    lag = 1
+    while lag < num_spikes:
+        within = (times[lag:] - times[:-lag]) <= delta_frames
+        if not np.any(within):
+            break
+        within &= sorting_indices[lag:] != sorting_indices[:-lag]
+        a = np.nonzero(within)[0]
+        pairs_i.extend([a, a + lag])
+        pairs_j.extend([a + lag, a])
+        lag += 1
+    match_counts = np.zeros((num_units, num_units), dtype=np.int64)
+    if len(pairs_i) > 0:
+        i = np.concatenate(pairs_i)
+        j = np.concatenate(pairs_j)
+        # the nearest spike j of each unit for each spike i
+        o = np.lexsort((j, np.abs(times[j] - times[i]), labels[j], i))
+        i = i[o]
+        j = j[o]
+        first = np.ones(len(i), dtype=bool)
+        first[1:] = (i[1:] != i[:-1]) | (labels[j[1:]] != labels[j[:-1]])
+        i = i[first]
+        j = j[first]
+        # mutual nearest pairs, each counted once
+        nearest = i * num_spikes + j
+        mutual = np.isin(j * num_spikes + i, nearest) & (i < j)
+        a = labels[i[mutual]]
+        b = labels[j[mutual]]
+        counts = np.bincount(a * num_units + b, minlength=num_units * num_units).reshape((num_units, num_units))
+        match_counts = counts + counts.T
+
+    denom = unit_spike_counts[:, None] + unit_spike_counts[None, :] - match_counts
+    agreement = np.divide(match_counts, denom, out=np.zeros(match_counts.shape, dtype=np.float64), where=denom > 0)
+    return {
+        'unit_offsets': unit_offsets.astype(np.int64),
+        'unit_spike_counts': unit_spike_counts,
+        'match_counts': match_counts.astype(np.int32),
+        'agreement': agreement.astype(np.float32)
+    }
+
+def _run_compare_sorters(sorting_true_npz_uri: str, sortings: List[dict], delta_time_ms: float) -> dict:
+    names = ['true'] + [s['name'] for s in sortings]
+    sorting_npz_uris = [sorting_true_npz_uri] + [s['sorting_npz_uri'] for s in sortings]
+    print('Loading sortings...')
+    spike_trains_list = [load_spike_trains(uri) for uri in sorting_npz_uris]
+    sampling_frequency = spike_trains_list[0].sampling_frequency
+    for name, st in zip(names, spike_trains_list):
+        assert st.sampling_frequency == sampling_frequency, f'Sampling frequency mismatch for {name}: {st.sampling_frequency} <> {sampling_frequency}'
+    delta_frames = int(round(delta_time_ms / 1000 * sampling_frequency))
+
+    print(f'Computing agreement matrix ({sum([len(st.unit_ids) for st in spike_trains_list])} units, {sum([st.num_spikes for st in spike_trains_list])} spikes)...')
+    x = compute_agreement_matrix(spike_trains_list, delta_frames=delta_frames)
+
+    with scratch_directory('compare-sorters', sum([os.path.getsize(st.path) for st in spike_trains_list])) as tmpdir:
+        sorter_agreement_path = f'{tmpdir}/sorter_agreement.npz'
+        np.savez_compressed(
+            sorter_agreement_path,
+            sorting_names=np.array(names),
+            sorting_npz_uris=np.array(sorting_npz_uris),
+            unit_ids=np.array([str(u) for st in spike_trains_list for u in st.unit_ids]),
+            delta_frames=np.array([delta_frames]),
+            **x
+        )
+        print('Storing sorter agreement...')
+        sorter_agreement_uri = store_output_file(sorter_agreement_path)
+    return {'sorter_agreement_uri': sorter_agreement_uri}
+
+@click.command()
+@click.argument('config_file')
+@click.option('--force-run', is_flag=True, help="Force rerun")
+def main(config_file: str, force_run: bool):
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    config_name = config['name']
+    jobs: List[Job] = load_workflow_jobs(config_name)
+    jobs = [job for job in jobs if job.type == 'compare-sorters']
+    outputs = get_async_client().get_many([job.key() for job in jobs]) if not force_run else [None] * len(jobs)
+    jobs_to_run = [
+        job for job, output in zip(jobs, outputs)
+        if force_run or job.force_run or (output is None)
+    ]
+    print('JOBS TO RUN:')
+    for job in jobs_to_run:
+        print(job.label)
+    print('')
+    print(f'Total number of jobs: {len(jobs)}')
+    print(f'Number of jobs to run: {len(jobs_to_run)}')
+    print('')
+
+    for job in jobs_to_run:
+        print(f'Running: {job.label}')
+        with record_job_stats(job):
+            output = _run_compare_sorters(**job.kwargs)
+        print('OUTPUT')
+        print(output)
+        kc.set(job.key(), output)
+    if len(jobs_to_run) > 0:
+        print(get_scratch_manager().summary())
+
+if __name__ == '__main__':
+    main()
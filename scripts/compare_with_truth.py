@@ -3,17 +3,22 @@
 import os
 import click
 import yaml
-import runarepo
 from typing import List, Union
 import kachery_client as kc
 from Job import Job
+from async_kachery import get_async_client
+from workflow_lists import load_workflow_jobs
+from job_stats import record_job_stats
+from output_store import store_output_file
+from scratch import get_scratch_manager, scratch_directory
 
 def _run_compare_with_truth(sorting_npz_uri: str, sorting_true_npz_uri: str, use_docker: bool, use_singularity: bool, image: Union[str, None]) -> dict:
-    with kc.TemporaryDirectory() as tmpdir:
-        sorting_npz_path = kc.load_file(sorting_npz_uri)
-        assert sorting_npz_path is not None, f'Unable to load: {sorting_npz_uri}'
-        sorting_true_npz_path = kc.load_file(sorting_true_npz_uri)
-        assert sorting_true_npz_path is not None, f'Unable to load: {sorting_true_npz_uri}'
+    import runarepo
+    sorting_npz_path = kc.load_file(sorting_npz_uri)
+    assert sorting_npz_path is not None, f'Unable to load: {sorting_npz_uri}'
+    sorting_true_npz_path = kc.load_file(sorting_true_npz_uri)
+    assert sorting_true_npz_path is not None, f'Unable to load: {sorting_true_npz_uri}'
+    with scratch_directory('compare-with-truth', os.path.getsize(sorting_npz_path) + os.path.getsize(sorting_true_npz_path)) as tmpdir:
         output_dir = f'{tmpdir}/output'
 
         repo = os.environ.get('SPIKESORTING_RUNAREPO_PATH', 'https://github.com/scratchrealm/spikesorting-runarepo')
@@ -29,7 +34,7 @@ def _run_compare_with_truth(sorting_npz_uri: str, sorting_true_npz_uri: str, use
             raise Exception(f'Non-zero return code in comparison: {output.retcode}')
 
         print('Storing comparison output...')
-        comparison_uri = kc.store_file(f'{output_dir}/comparison.json')
+        comparison_uri = store_output_file(f'{output_dir}/comparison.json')
         return {'comparison_uri': comparison_uri}
 
 @click.command()
@@ -42,12 +47,12 @@ def main(config_file: str, docker: bool, force_run: bool, singularity: bool, ima
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
     config_name = config['name']
-    jobs0 = kc.get({'type': 'spikeforest-workflow-jobs', 'name': config_name})
-    jobs: List[Job] = [Job.from_dict(job0) for job0 in jobs0]
+    jobs: List[Job] = load_workflow_jobs(config_name)
     jobs = [job for job in jobs if job.type == 'compare-with-truth']
+    outputs = get_async_client().get_many([job.key() for job in jobs]) if not force_run else [None] * len(jobs)
     jobs_to_run = [
-        job for job in jobs
-        if force_run or job.force_run or (kc.get(job.key()) is None)
+        job for job, output in zip(jobs, outputs)
+        if force_run or job.force_run or (output is None)
     ]
     print('JOBS TO RUN:')
     for job in jobs_to_run:
@@ -59,10 +64,13 @@ def main(config_file: str, docker: bool, force_run: bool, singularity: bool, ima
 
     for job in jobs_to_run:
         print(f'Running: {job.label}')
-        output = _run_compare_with_truth(**job.kwargs, use_docker=docker, use_singularity=singularity, image=image)
+        with record_job_stats(job, measure_memory=not docker):
+            output = _run_compare_with_truth(**job.kwargs, use_docker=docker, use_singularity=singularity, image=image)
         print('OUTPUT')
         print(output)
         kc.set(job.key(), output)
+    if len(jobs_to_run) > 0:
+        print(get_scratch_manager().summary())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,181 @@
+import os
+import sys
+import gzip
+import json
+import zlib
+import time
+import codecs
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Union
+import kachery_client as kc
+from output_store import store_output_file
+
+# Console output of sorting runs is streamed into a gzip-compressed log on
+# disk while the job is running (so it can be followed with tail_console.py)
+# and only a bounded head/tail of the lines is retained for storage.
+
+class ConsoleLog:
+    def __init__(self, path: str, head_lines: int=1000, tail_lines: int=1000, max_bytes: int=100 * 1024 * 1024, max_line_length: int=10000) -> None:
+        self._path = path
+        self._head_lines = head_lines
+        self._max_bytes = max_bytes
+        self._max_line_length = max_line_length
+        self._head: List[str] = []
+        self._tail = deque(maxlen=tail_lines)
+        self._num_lines = 0
+        self._num_bytes = 0
+        self._capped = False
+        self._partial = ''
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._file = gzip.open(path, 'wb')
+    @property
+    def path(self):
+        return self._path
+    @property
+    def num_lines(self):
+        return self._num_lines
+    def write(self, text: str):
+        with self._lock:
+            lines = (self._partial + text).split('\n')
+            # progress output that only uses \r would otherwise grow one line
+            # without bound (one extra character marks the line as truncated)
+            self._partial = lines.pop()[:self._max_line_length + 1]
+            for line in lines:
+                self._add_line(line)
+            if time.time() - self._last_flush > 1:
+                self._flush()
+    def reset(self):
+        # discard everything written so far
+        with self._lock:
+            self._file.close()
+            self._file = gzip.open(self._path, 'wb')
+            self._head = []
+            self._tail.clear()
+            self._num_lines = 0
+            self._num_bytes = 0
+            self._capped = False
+            self._partial = ''
+    def add_lines(self, lines: List[str]):
+        with self._lock:
+            for line in lines:
+                self._add_line(line)
+            self._flush()
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._partial:
+                self._add_line(self._partial)
+                self._partial = ''
+            if self._capped:
+                num_omitted = self._num_lines - len(self._head) - len(self._tail)
+                self._file.write(f'... {num_omitted} lines omitted ...\n'.encode('utf-8'))
+                for line in self._tail:
+                    self._file.write(f'{line}\n'.encode('utf-8'))
+            self._file.close()
+    def to_dict(self):
+        return {
+            'type': 'spikeforest-console-log',
+            'num_lines': self._num_lines,
+            'head': list(self._head),
+            'tail': list(self._tail)
+        }
+    def store(self) -> str:
+        stored_path = f'{os.path.dirname(self._path)}/console_lines.json.gz'
+        with gzip.open(stored_path, 'wt') as f:
+            json.dump(self.to_dict(), f)
+        return store_output_file(stored_path)
+    def _add_line(self, line: str):
+        if len(line) > self._max_line_length:
+            line = line[:self._max_line_length] + ' ... (line truncated)'
+        self._num_lines += 1
+        if len(self._head) < self._head_lines:
+            self._head.append(line)
+        else:
+            self._tail.append(line)
+        if self._capped:
+            return
+        b = f'{line}\n'.encode('utf-8')
+        if self._num_bytes + len(b) > self._max_bytes:
+            self._capped = True
+            self._file.write(f'... console log capped at {self._max_bytes} bytes ...\n'.encode('utf-8'))
+            self._flush()
+            return
+        self._file.write(b)
+        self._num_bytes += len(b)
+    def _flush(self):
+        # sync flush so that a reader can decompress everything written so far
+        self._file.flush()
+        self._last_flush = time.time()
+
+@contextmanager
+def capture_console(console_log: ConsoleLog):
+    # Redirect file descriptors 1 and 2 (including those inherited by
+    # subprocesses) through a pipe, teeing to the original stdout and the log
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    read_fd, write_fd = os.pipe()
+    def _reader():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            os.write(saved_stdout, chunk)
+            console_log.write(decoder.decode(chunk))
+    thread = threading.Thread(target=_reader, daemon=True)
+    thread.start()
+    os.dup2(write_fd, 1)
+    os.dup2(write_fd, 2)
+    os.close(write_fd)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        thread.join()
+        os.close(read_fd)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+
+def get_console_log_key(config_name: str, label: str):
+    return {'type': 'spikeforest-console-log', 'name': config_name, 'label': label}
+
+def load_console_lines(uri: str) -> Union[List[str], None]:
+    # Handles both the capped form and the plain list of lines stored by
+    # earlier versions (kc.store_json)
+    path = kc.load_file(uri)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    x = json.loads(data.decode('utf-8'))
+    if isinstance(x, list):
+        return x
+    num_omitted = x['num_lines'] - len(x['head']) - len(x['tail'])
+    if num_omitted > 0:
+        return x['head'] + [f'... {num_omitted} lines omitted ...'] + x['tail']
+    return x['head'] + x['tail']
+
+class ConsoleLogReader:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._offset = 0
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    def read(self) -> str:
+        # return any newly written (and flushed) text
+        with open(self._path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        self._offset += len(data)
+        return self._decoder.decode(self._decompressor.decompress(data))
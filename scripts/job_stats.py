@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import kachery_client as kc
+from Job import Job
+
+# Runtime and memory of finished jobs, keyed by job type and label (which,
+# unlike the job key, is known before upstream outputs exist). Used by
+# plan.py to estimate the cost of a config.
+
+def get_job_stats_key(job_type: str, label: str):
+    return {'type': 'spikeforest-job-stats', 'job_type': job_type, 'label': label}
+
+def get_job_stats(job_type: str, label: str):
+    return kc.get(get_job_stats_key(job_type, label))
+
+_sample_interval_sec = 1
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def _get_process_tree_rss_bytes(pid: int):
+    # resident memory of the process and all of its descendants, from /proc
+    parents = {}
+    rss = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                stat = f.read()
+            with open(f'/proc/{name}/statm', 'r') as f:
+                statm = f.read().split()
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+        # the command name (in parentheses) may contain spaces
+        parents[int(name)] = int(stat[stat.rindex(')') + 2:].split()[1])
+        rss[int(name)] = int(statm[1]) * _page_size
+    tree = set([pid])
+    added = True
+    while added:
+        added = False
+        for p, ppid in parents.items():
+            if ppid in tree and p not in tree:
+                tree.add(p)
+                added = True
+    return sum([rss.get(p, 0) for p in tree])
+
+@contextmanager
+def record_job_stats(job: Job, measure_memory: bool=True):
+    # Peak memory is the peak resident memory of this process and its
+    # descendants, sampled while the job runs. It is not recorded where it
+    # cannot be measured (no /proc, or the sorter runs in a docker container,
+    # which is not a descendant), and plan.py then uses its size-based
+    # estimate.
+    measure_memory = measure_memory and os.path.isdir('/proc/self')
+    peak = {'rss_bytes': 0}
+    done = threading.Event()
+    def _monitor():
+        while True:
+            peak['rss_bytes'] = max(peak['rss_bytes'], _get_process_tree_rss_bytes(os.getpid()))
+            if done.wait(_sample_interval_sec):
+                break
+    thread = threading.Thread(target=_monitor, daemon=True) if measure_memory else None
+    if thread is not None:
+        thread.start()
+    timer = time.time()
+    try:
+        yield
+    finally:
+        done.set()
+        if thread is not None:
+            thread.join()
+    kc.set(get_job_stats_key(job.type, job.label), {
+        'elapsed_sec': time.time() - timer,
+        'peak_rss_bytes': peak['rss_bytes'] if measure_memory else None,
+        'timestamp': time.time()
+    })
@@ -0,0 +1,79 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import Union
+import kachery_client as kc
+
+# Job outputs (recording.nwb, sorting.npz, comparison.json, ...) are written
+# into a scratch directory on the same filesystem as the kachery storage
+# directory, so that storing them is a hardlink rather than a second full
+# copy of the bytes. If the storage directory is not known (KACHERY_STORAGE_DIR
+# not set) we fall back to kc.TemporaryDirectory() / kc.store_file().
+
+_chunk_size = 16 * 1024 * 1024
+
+def _get_storage_dir() -> Union[str, None]:
+    storage_dir = os.environ.get('KACHERY_STORAGE_DIR', None)
+    if not storage_dir or not os.path.isdir(f'{storage_dir}/sha1'):
+        return None
+    return storage_dir
+
+def get_output_scratch_dir() -> Union[str, None]:
+    storage_dir = _get_storage_dir()
+    if storage_dir is None:
+        return None
+    scratch_dir = f'{storage_dir}/spikeforest-scratch'
+    os.makedirs(scratch_dir, exist_ok=True)
+    return scratch_dir
+
+@contextmanager
+def output_directory():
+    scratch_dir = get_output_scratch_dir()
+    if scratch_dir is None:
+        with kc.TemporaryDirectory() as tmpdir:
+            yield tmpdir
+        return
+    tmpdir = tempfile.mkdtemp(prefix=f'job-{os.getpid()}-', dir=scratch_dir)
+    try:
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def compute_file_sha1(path: str) -> str:
+    hh = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_chunk_size)
+            if not chunk:
+                break
+            hh.update(chunk)
+    return hh.hexdigest()
+
+def store_output_file(path: str) -> str:
+    storage_dir = _get_storage_dir()
+    if storage_dir is None:
+        return kc.store_file(path)
+    sha1 = compute_file_sha1(path)
+    dest_dir = f'{storage_dir}/sha1/{sha1[0:2]}/{sha1[2:4]}/{sha1[4:6]}'
+    dest_path = f'{dest_dir}/{sha1}'
+    if not os.path.exists(dest_path):
+        os.makedirs(dest_dir, exist_ok=True)
+        _place_file(path, dest_path)
+    return f'sha1://{sha1}/{os.path.basename(path)}'
+
+def _place_file(path: str, dest_path: str):
+    # write to a temporary name and rename, so that a partially placed file
+    # is never visible under its content hash
+    tmp_path = f'{dest_path}.tmp-{os.getpid()}'
+    try:
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            # different filesystem (or no hardlink support): copy
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
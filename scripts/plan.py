@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import heapq
+import click
+import yaml
+from typing import Dict, List, Union
+import kachery_client as kc
+from async_kachery import get_async_client
+from job_stats import get_job_stats_key
+from workflow import get_config_entries, get_job_label, get_spikeforest_recording, sf_study_sets_uri
+
+# Size-based estimates, used when a job has no recorded stats. The size of a
+# recording is its number of channel-seconds; a job is estimated to take
+# base_sec + sec_per_channel_sec * size seconds and memory_gb of memory.
+# Keys are job types, or sorting:<algorithm> for sorting jobs.
+default_estimates = {
+    'prepare-recording-nwb': {'base_sec': 60, 'sec_per_channel_sec': 0.002, 'memory_gb': 4},
+    'prepare-sorting-true-npz': {'base_sec': 30, 'sec_per_channel_sec': 0, 'memory_gb': 1},
+    'sorting-metrics': {'base_sec': 120, 'sec_per_channel_sec': 0.002, 'memory_gb': 4},
+    'sorting:mountainsort4': {'base_sec': 120, 'sec_per_channel_sec': 0.02, 'memory_gb': 8},
+    'sorting:spykingcircus': {'base_sec': 180, 'sec_per_channel_sec': 0.03, 'memory_gb': 8},
+    'sorting:tridesclous': {'base_sec': 180, 'sec_per_channel_sec': 0.03, 'memory_gb': 8},
+    'sorting:kilosort3': {'base_sec': 300, 'sec_per_channel_sec': 0.005, 'memory_gb': 16},
+    'sorting:kilosort2_5': {'base_sec': 300, 'sec_per_channel_sec': 0.005, 'memory_gb': 16},
+    'sorting:kilosort2': {'base_sec': 300, 'sec_per_channel_sec': 0.005, 'memory_gb': 16},
+    'sorting-figurl': {'base_sec': 120, 'sec_per_channel_sec': 0.001, 'memory_gb': 4},
+    'compare-with-truth': {'base_sec': 60, 'sec_per_channel_sec': 0, 'memory_gb': 2},
+    'compare-sorters': {'base_sec': 30, 'sec_per_channel_sec': 0, 'memory_gb': 2}
+}
+
+class PlannedJob:
+    def __init__(self,
+        type: str,
+        label: str,
+        estimate_key: str,
+        size: float,
+        deps: List[int]
+    ) -> None:
+        self.type = type
+        self.label = label
+        self.estimate_key = estimate_key
+        self.size = size
+        self.deps = deps
+        self.duration_sec = 0.
+        self.memory_gb = 0.
+        self.recorded = False
+        self.memory_recorded = False
+
+def _expand_config(config: dict, sf_study_sets: dict) -> List[PlannedJob]:
+    # The same job graph as workflow.py builds, except that jobs are
+    # identified by label (their kwargs depend on upstream outputs)
+    jobs: List[PlannedJob] = []
+    def add_job(type: str, label: str, size: float, deps: List[int], estimate_key: Union[str, None]=None):
+        jobs.append(PlannedJob(type=type, label=label, estimate_key=estimate_key or type, size=size, deps=deps))
+        return len(jobs) - 1
+    for _, config_study, recording_name, sorters0 in get_config_entries(config):
+        recording = get_spikeforest_recording(sf_study_sets, config_study['study_set_name'], config_study['study_name'], recording_name)
+        size = float(recording.get('durationSec', 0)) * float(recording.get('numChannels', 0))
+        j_nwb = add_job('prepare-recording-nwb', get_job_label('prepare-recording-nwb', recording), size, [])
+        j_true = add_job('prepare-sorting-true-npz', get_job_label('prepare-sorting-true-npz', recording), size, [])
+        add_job('sorting-metrics', get_job_label('sorting-metrics', recording), size, [j_nwb, j_true])
+        j_sortings: List[int] = []
+        for sorter in sorters0:
+            sorter_name = sorter['name']
+            j_sorting = add_job('sorting', get_job_label('sorting', recording, sorter_name), size, [j_nwb], estimate_key=f'sorting:{sorter["algorithm"]}')
+            j_sortings.append(j_sorting)
+            add_job('sorting-figurl', get_job_label('sorting-figurl', recording, sorter_name), size, [j_nwb, j_sorting])
+            add_job('compare-with-truth', get_job_label('compare-with-truth', recording, sorter_name), size, [j_sorting, j_true])
+        if len(j_sortings) > 0:
+            add_job('compare-sorters', get_job_label('compare-sorters', recording), size, [j_true] + j_sortings)
+    return jobs
+
+def _estimate(jobs: List[PlannedJob], estimates: Dict[str, dict], use_recorded: bool):
+    # Recorded stats are used directly where available, and also to rescale
+    # the per-channel-second rate for other jobs with the same estimate key
+    # (the recorded time includes the fixed overhead, base_sec)
+    recorded_rates: Dict[str, List[float]] = {}
+    stats_list = get_async_client().get_many([get_job_stats_key(job.type, job.label) for job in jobs]) if use_recorded else [None] * len(jobs)
+    for job, stats in zip(jobs, stats_list):
+        if stats is not None:
+            job.duration_sec = stats['elapsed_sec']
+            # older stats (peak_memory_bytes) were process-lifetime maxima and are not used
+            if stats.get('peak_rss_bytes', None) is not None:
+                job.memory_gb = stats['peak_rss_bytes'] / 1e9
+                job.memory_recorded = True
+            job.recorded = True
+            e = estimates.get(job.estimate_key, None)
+            if job.size > 0 and e is not None:
+                recorded_rates.setdefault(job.estimate_key, []).append(max(0., stats['elapsed_sec'] - e['base_sec']) / job.size)
+    for job in jobs:
+        if job.memory_recorded:
+            continue
+        e = estimates.get(job.estimate_key, None)
+        if e is None:
+            raise Exception(f'No estimate for: {job.estimate_key}')
+        job.memory_gb = e['memory_gb']
+        if job.recorded:
+            continue
+        rates = recorded_rates.get(job.estimate_key, None)
+        rate = sum(rates) / len(rates) if rates else e['sec_per_channel_sec']
+        job.duration_sec = e['base_sec'] + rate * job.size
+
+def _get_critical_path(jobs: List[PlannedJob]):
+    # jobs are in topological order (dependencies are added first)
+    finish = [0.] * len(jobs)
+    prev: List[Union[int, None]] = [None] * len(jobs)
+    for i, job in enumerate(jobs):
+        start = 0.
+        for d in job.deps:
+            if finish[d] > start:
+                start = finish[d]
+                prev[i] = d
+        finish[i] = start + job.duration_sec
+    i = max(range(len(jobs)), key=lambda k: finish[k])
+    path: List[int] = []
+    while i is not None:
+        path.append(i)
+        i = prev[i]
+    return list(reversed(path))
+
+def _get_bottom_levels(jobs: List[PlannedJob]):
+    # longest remaining path from each job, used as the scheduling priority
+    dependents: List[List[int]] = [[] for _ in jobs]
+    for i, job in enumerate(jobs):
+        for d in job.deps:
+            dependents[d].append(i)
+    levels = [0.] * len(jobs)
+    for i in reversed(range(len(jobs))):
+        levels[i] = jobs[i].duration_sec + max([levels[k] for k in dependents[i]], default=0.)
+    return levels, dependents
+
+def _simulate(jobs: List[PlannedJob], num_nodes: int, num_parallel: int, node_memory_gb: Union[float, None]):
+    # List scheduling: whenever a slot frees up, start the ready job with the
+    # longest remaining path on a node with a free slot and enough memory
+    levels, dependents = _get_bottom_levels(jobs)
+    num_waiting = [len(job.deps) for job in jobs]
+    ready = [i for i in range(len(jobs)) if num_waiting[i] == 0]
+    free_slots = [num_parallel] * num_nodes
+    memory = [0.] * num_nodes
+    peak_memory = [0.] * num_nodes
+    running: List[tuple] = []
+    t = 0.
+    num_done = 0
+    while num_done < len(jobs):
+        ready.sort(key=lambda i: -levels[i])
+        still_ready: List[int] = []
+        for i in ready:
+            candidates = [
+                n for n in range(num_nodes)
+                if free_slots[n] > 0 and (node_memory_gb is None or memory[n] + jobs[i].memory_gb <= node_memory_gb)
+            ]
+            if len(candidates) == 0:
+                still_ready.append(i)
+                continue
+            n = max(candidates, key=lambda n: (free_slots[n], -memory[n]))
+            free_slots[n] -= 1
+            memory[n] += jobs[i].memory_gb
+            peak_memory[n] = max(peak_memory[n], memory[n])
+            heapq.heappush(running, (t + jobs[i].duration_sec, i, n))
+        ready = still_ready
+        if len(running) == 0:
+            raise Exception(f'Job does not fit on a node ({node_memory_gb} GB): {jobs[ready[0]].label} ({jobs[ready[0]].memory_gb:.1f} GB)')
+        t, i, n = heapq.heappop(running)
+        free_slots[n] += 1
+        memory[n] -= jobs[i].memory_gb
+        num_done += 1
+        for k in dependents[i]:
+            num_waiting[k] -= 1
+            if num_waiting[k] == 0:
+                ready.append(k)
+    return t, peak_memory
+
+def _format_duration(sec: float):
+    h = int(sec // 3600)
+    m = int((sec % 3600) // 60)
+    s = int(sec % 60)
+    return f'{h}:{m:02d}:{s:02d}'
+
+@click.command()
+@click.argument('config_file')
+@click.option('--num-nodes', default=1, help="Number of compute nodes")
+@click.option('--num-parallel', default=1, help="Maximum number of jobs run simultaneously on each node")
+@click.option('--node-memory-gb', default=None, type=float, help="Memory available on each node")
+@click.option('--estimates', default=None, help="YAML file overriding the size-based estimates (same keys as default_estimates in plan.py)")
+@click.option('--ignore-recorded', is_flag=True, help="Use only size-based estimates, ignoring recorded job stats")
+@click.option('--verbose', is_flag=True, help="Print the estimate for every job")
+def main(config_file: str, num_nodes: int, num_parallel: int, node_memory_gb: Union[float, None], estimates: Union[str, None], ignore_recorded: bool, verbose: bool):
+    """Predict the makespan, peak memory and critical path of a config without running anything."""
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    config_name = config['name']
+    estimates0 = dict(default_estimates)
+    if estimates is not None:
+        with open(estimates, 'r') as f:
+            estimates0.update(yaml.safe_load(f))
+
+    sf_study_sets = kc.load_json(sf_study_sets_uri)
+    assert sf_study_sets is not None, f'Unable to load sf study sets: {sf_study_sets_uri}'
+
+    jobs = _expand_config(config, sf_study_sets)
+    if len(jobs) == 0:
+        print('No jobs.')
+        return
+    _estimate(jobs, estimates0, use_recorded=not ignore_recorded)
+    makespan, peak_memory = _simulate(jobs, num_nodes=num_nodes, num_parallel=num_parallel, node_memory_gb=node_memory_gb)
+    critical_path = _get_critical_path(jobs)
+
+    print(f'Config name: {config_name}')
+    if verbose:
+        print('-----------------------------')
+        print('JOBS:')
+        for job in jobs:
+            a = '' if job.recorded else '~'
+            print(f'{a}{_format_duration(job.duration_sec)} {job.memory_gb:.1f} GB {job.type}: {job.label}')
+    print('-----------------------------')
+    print('JOB TYPES:')
+    for job_type in sorted(set([job.type for job in jobs])):
+        x = [job for job in jobs if job.type == job_type]
+        print(f'{job_type}: {len(x)} jobs, {sum([job.duration_sec for job in x]) / 3600:.2f} job-hours ({len([job for job in x if job.recorded])} recorded)')
+    print('-----------------------------')
+    print('CRITICAL PATH:')
+    for i in critical_path:
+        print(f'{_format_duration(jobs[i].duration_sec)} {jobs[i].type}: {jobs[i].label}')
+    print('-----------------------------')
+    print(f'Total: {len(jobs)} jobs, {sum([job.duration_sec for job in jobs]) / 3600:.2f} job-hours')
+    print(f'Critical path: {_format_duration(sum([jobs[i].duration_sec for i in critical_path]))}')
+    print(f'Predicted makespan ({num_nodes} nodes x {num_parallel} parallel): {_format_duration(makespan)}')
+    print(f'Predicted peak memory per node: {max(peak_memory):.1f} GB')
+    print('-----------------------------')
+
+if __name__ == '__main__':
+    main()
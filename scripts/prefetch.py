@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+import kachery_client as kc
+from Job import Job
+
+# Fetch the inputs of upcoming jobs into the local kachery store in background
+# threads while the current job runs, so that the CPU is not idle during the
+# transfers. At most `lookahead` jobs are fetched ahead, and no new job is
+# started while the fetched-but-unused inputs exceed the disk budget (the
+# size of a file is only known once it has been fetched, so the budget can
+# be overshot by one job).
+
+class Prefetcher:
+    def __init__(self, jobs: List[Job], get_input_uris: Callable[[Job], List[str]], lookahead: int=2, disk_budget_bytes: float=50e9, num_threads: int=2) -> None:
+        self._jobs = jobs
+        self._get_input_uris = get_input_uris
+        self._lookahead = lookahead
+        self._disk_budget_bytes = disk_budget_bytes
+        self._executor = ThreadPoolExecutor(max_workers=num_threads) if lookahead > 0 else None
+        self._lock = threading.RLock()
+        self._next_index = 0
+        self._futures: Dict[int, Future] = {}
+        self._bytes: Dict[int, int] = {}
+        self._released = set()
+        self._num_fetched_bytes = 0
+        self._fetch_sec = 0.
+        self._wait_sec = 0.
+        self._waited_fetch_sec = 0.
+        self._schedule()
+    def wait(self, job: Job):
+        # block until the inputs of job are in the local store (prefetching
+        # off: the job loads its own inputs)
+        if self._executor is None:
+            return
+        i = self._index_of(job)
+        timer = time.time()
+        with self._lock:
+            future = self._futures.get(i, None)
+            if future is None:
+                # not prefetched (yet): fetch it now
+                future = Future()
+                self._futures[i] = future
+                fetch_now = True
+            else:
+                fetch_now = False
+        if fetch_now:
+            future.set_result(self._fetch(i))
+        fetch_sec = future.result()
+        with self._lock:
+            self._wait_sec += time.time() - timer
+            self._waited_fetch_sec += fetch_sec
+    def release(self, job: Job):
+        # the job is done with its inputs
+        i = self._index_of(job)
+        with self._lock:
+            self._released.add(i)
+        self._schedule()
+    def shutdown(self):
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=False)
+    def report(self) -> str:
+        hidden_sec = max(0., self._waited_fetch_sec - self._wait_sec)
+        return (
+            f'Prefetch: {self._num_fetched_bytes / 1e9:.2f} GB fetched in {self._fetch_sec:.1f} s; '
+            f'{self._wait_sec:.1f} s waiting for inputs, {hidden_sec:.1f} s of fetch time hidden'
+        )
+    def _index_of(self, job: Job):
+        return next(i for i, j in enumerate(self._jobs) if j is job)
+    def _outstanding_bytes(self):
+        return sum([b for i, b in self._bytes.items() if i not in self._released])
+    def _schedule(self):
+        if self._executor is None:
+            return
+        with self._lock:
+            while self._next_index < len(self._jobs):
+                num_ahead = len([i for i in self._futures if i not in self._released])
+                if num_ahead >= self._lookahead or self._outstanding_bytes() >= self._disk_budget_bytes:
+                    break
+                i = self._next_index
+                self._next_index += 1
+                if i in self._futures:
+                    continue
+                future = self._executor.submit(self._fetch, i)
+                future.add_done_callback(lambda f: self._schedule())
+                self._futures[i] = future
+    def _fetch(self, i: int):
+        timer = time.time()
+        num_bytes = 0
+        for uri in self._get_input_uris(self._jobs[i]):
+            num_bytes += fetch_uri(uri)
+        elapsed = time.time() - timer
+        with self._lock:
+            self._bytes[i] = num_bytes
+            self._num_fetched_bytes += num_bytes
+            self._fetch_sec += elapsed
+        return elapsed
+
+def fetch_uri(uri: str) -> int:
+    # also fetch the files referenced by json objects (e.g. the raw data of
+    # a recording object)
+    path = kc.load_file(uri)
+    assert path is not None, f'Unable to load: {uri}'
+    num_bytes = os.path.getsize(path)
+    if uri.endswith('.json'):
+        with open(path, 'r') as f:
+            x = json.load(f)
+        for uri0 in _find_uris(x):
+            num_bytes += fetch_uri(uri0)
+    return num_bytes
+
+def _find_uris(x) -> List[str]:
+    if isinstance(x, str):
+        return [x] if x.startswith('sha1://') else []
+    if isinstance(x, dict):
+        return [u for v in x.values() for u in _find_uris(v)]
+    if isinstance(x, list):
+        return [u for v in x for u in _find_uris(v)]
+    return []
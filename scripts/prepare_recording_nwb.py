@@ -3,16 +3,24 @@
 import click
 import yaml
 from typing import List
-import sortingview as sv
 import kachery_client as kc
 from Job import Job
-from spikeinterface.core.old_api_utils import OldToNewRecording
-from spikeinterface.toolkit.preprocessing import bandpass_filter
-from nwb_conversion_tools.utils.spike_interface import write_recording
-import spikeinterface.extractors as se
+from async_kachery import get_async_client
+from workflow_lists import load_workflow_jobs
+from prefetch import Prefetcher, fetch_uri
+from job_stats import record_job_stats
+from output_store import store_output_file
+from scratch import get_scratch_manager, scratch_directory
+from preprocessing import recording_nwb_preprocessing, get_recording_preprocessing, set_recording_preprocessing
 
 def _run_prepare_recording_nwb_job(recording_uri: str) -> dict:
-    with kc.TemporaryDirectory() as tmpdir:
+    import sortingview as sv
+    from spikeinterface.core.old_api_utils import OldToNewRecording
+    from spikeinterface.toolkit.preprocessing import bandpass_filter
+    from nwb_conversion_tools.utils.spike_interface import write_recording
+    # the size of the raw data (in the local store, if it was prefetched)
+    input_bytes = fetch_uri(recording_uri)
+    with scratch_directory('prepare-recording-nwb', input_bytes) as tmpdir:
         recording_nwb_path = f'{tmpdir}/recording.nwb'
 
         print('Loading recording...')
@@ -22,28 +30,41 @@ def _run_prepare_recording_nwb_job(recording_uri: str) -> dict:
         recording = OldToNewRecording(recording)
         recording.clear_channel_groups()
 
-        recording = bandpass_filter(recording=recording, freq_min=300., freq_max=6000., margin_ms=5.0, dtype='float32')
+        for step in recording_nwb_preprocessing:
+            assert step['type'] == 'bandpass_filter', f'Unexpected preprocessing step: {step["type"]}'
+            recording = bandpass_filter(recording=recording, freq_min=step['freq_min'], freq_max=step['freq_max'], margin_ms=step['margin_ms'], dtype='float32')
 
         print('Writing recording nwb...')
         write_recording(recording, save_path=recording_nwb_path, compression=None, compression_opts=None)
         print('Storing recording nwb...')
-        recording_nwb_uri = kc.store_file(recording_nwb_path)
-        return {'recording_nwb_uri': recording_nwb_uri}
+        recording_nwb_uri = store_output_file(recording_nwb_path)
+        set_recording_preprocessing(recording_nwb_uri, recording_nwb_preprocessing)
+        return {'recording_nwb_uri': recording_nwb_uri, 'preprocessing': recording_nwb_preprocessing}
+
+def _register_preprocessing(jobs_with_outputs: List[tuple]):
+    # recordings prepared before the preprocessing was registered
+    for job, output in jobs_with_outputs:
+        recording_nwb_uri = output.get('recording_nwb_uri', None) if output is not None else None
+        if recording_nwb_uri is not None and get_recording_preprocessing(recording_nwb_uri) is None:
+            set_recording_preprocessing(recording_nwb_uri, output.get('preprocessing', recording_nwb_preprocessing))
 
 @click.command()
 @click.argument('config_file')
 @click.option('--force-run', is_flag=True, help="Force rerun")
-def main(config_file: str, force_run: bool):
+@click.option('--prefetch', default=2, help="Number of upcoming jobs whose inputs are fetched in the background (0 to disable)")
+@click.option('--prefetch-disk-budget-gb', default=50., help="Maximum size of prefetched inputs not yet used")
+def main(config_file: str, force_run: bool, prefetch: int, prefetch_disk_budget_gb: float):
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
     config_name = config['name']
-    jobs0 = kc.get({'type': 'spikeforest-workflow-jobs', 'name': config_name})
-    jobs: List[Job] = [Job.from_dict(job0) for job0 in jobs0]
+    jobs: List[Job] = load_workflow_jobs(config_name)
     jobs = [job for job in jobs if job.type == 'prepare-recording-nwb']
+    outputs = get_async_client().get_many([job.key() for job in jobs]) if not force_run else [None] * len(jobs)
     jobs_to_run = [
-        job for job in jobs
-        if force_run or job.force_run or (kc.get(job.key()) is None)
+        job for job, output in zip(jobs, outputs)
+        if force_run or job.force_run or (output is None)
     ]
+    _register_preprocessing([(job, output) for job, output in zip(jobs, outputs) if job not in jobs_to_run])
     print('JOBS TO RUN:')
     for job in jobs_to_run:
         print(job.label)
@@ -52,12 +73,19 @@ def main(config_file: str, force_run: bool):
     print(f'Number of jobs to run: {len(jobs_to_run)}')
     print('')
 
+    prefetcher = Prefetcher(jobs_to_run, lambda job: [job.kwargs['recording_uri']], lookahead=prefetch, disk_budget_bytes=prefetch_disk_budget_gb * 1e9)
     for job in jobs_to_run:
         print(f'Running: {job.label}')
-        output = _run_prepare_recording_nwb_job(**job.kwargs)
+        prefetcher.wait(job)
+        with record_job_stats(job):
+            output = _run_prepare_recording_nwb_job(**job.kwargs)
+        prefetcher.release(job)
         print('OUTPUT')
         print(output)
         kc.set(job.key(), output)
+    prefetcher.shutdown()
+    print(prefetcher.report())
+    print(get_scratch_manager().summary())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
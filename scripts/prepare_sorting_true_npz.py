@@ -3,14 +3,21 @@
 import click
 import yaml
 from typing import List
-import sortingview as sv
 import kachery_client as kc
 from Job import Job
-from spikeinterface.core.old_api_utils import OldToNewSorting
-import spikeinterface.extractors as se
+from async_kachery import get_async_client
+from workflow_lists import load_workflow_jobs
+from job_stats import record_job_stats
+from output_store import store_output_file
+from scratch import get_scratch_manager, scratch_directory
 
 def _run_prepare_sorting_true_npz_job(recording_uri: str, sorting_true_uri: str) -> dict:
-    with kc.TemporaryDirectory() as tmpdir:
+    import sortingview as sv
+    import spikeinterface.extractors as se
+    from spikeinterface.core.old_api_utils import OldToNewSorting
+    from spike_trains import store_spike_trains_for_npz
+    # the size of the inputs is not known before they are loaded
+    with scratch_directory('prepare-sorting-true-npz', 0) as tmpdir:
         sorting_true_npz_path = f'{tmpdir}/sorting_true.npz'
 
         # need to load the recording in order to get the sampling freq for the sorting
@@ -27,8 +34,10 @@ def _run_prepare_sorting_true_npz_job(recording_uri: str, sorting_true_uri: str)
         print(f'Writing sorting true npz (samplerate={sorting.get_sampling_frequency()})...')
         se.NpzSortingExtractor.write_sorting(sorting=sorting, save_path=sorting_true_npz_path)
         print('Storing sorting true npz...')
-        sorting_true_npz_uri = kc.store_file(sorting_true_npz_path)
-        return {'sorting_true_npz_uri': sorting_true_npz_uri}
+        sorting_true_npz_uri = store_output_file(sorting_true_npz_path)
+        print('Storing sorting true spike trains...')
+        sorting_true_spikes_uri = store_spike_trains_for_npz(sorting_true_npz_path, sorting_true_npz_uri)
+        return {'sorting_true_npz_uri': sorting_true_npz_uri, 'sorting_true_spikes_uri': sorting_true_spikes_uri}
 
 @click.command()
 @click.argument('config_file')
@@ -37,12 +46,12 @@ def main(config_file: str, force_run: bool):
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
     config_name = config['name']
-    jobs0 = kc.get({'type': 'spikeforest-workflow-jobs', 'name': config_name})
-    jobs: List[Job] = [Job.from_dict(job0) for job0 in jobs0]
+    jobs: List[Job] = load_workflow_jobs(config_name)
     jobs = [job for job in jobs if job.type == 'prepare-sorting-true-npz']
+    outputs = get_async_client().get_many([job.key() for job in jobs]) if not force_run else [None] * len(jobs)
     jobs_to_run = [
-        job for job in jobs
-        if force_run or job.force_run or (kc.get(job.key()) is None)
+        job for job, output in zip(jobs, outputs)
+        if force_run or job.force_run or (output is None)
     ]
     print('JOBS TO RUN:')
     for job in jobs_to_run:
@@ -54,10 +63,13 @@ def main(config_file: str, force_run: bool):
 
     for job in jobs_to_run:
         print(f'Running: {job.label}')
-        output = _run_prepare_sorting_true_npz_job(**job.kwargs)
+        with record_job_stats(job):
+            output = _run_prepare_sorting_true_npz_job(**job.kwargs)
         print('OUTPUT')
         print(output)
         kc.set(job.key(), output)
+    if len(jobs_to_run) > 0:
+        print(get_scratch_manager().summary())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
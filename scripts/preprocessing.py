@@ -0,0 +1,56 @@
+import copy
+from typing import List, Union
+import kachery_client as kc
+
+# Machine-readable provenance of the preprocessing applied to a prepared
+# recording nwb, registered under its URI, and the knowledge of which sorter
+# parameters repeat those steps.
+
+# preprocessing applied by prepare_recording_nwb.py
+recording_nwb_preprocessing = [
+    {'type': 'bandpass_filter', 'freq_min': 300., 'freq_max': 6000., 'margin_ms': 5.0}
+]
+
+# sorting params that switch on a preprocessing step in the sorter, and the
+# params that configure it
+sorter_preprocessing_params = {
+    'mountainsort4': {
+        'bandpass_filter': {'flag': 'filter', 'freq_min': 'freq_min', 'freq_max': 'freq_max'},
+        'whiten': {'flag': 'whiten'}
+    }
+}
+
+def get_recording_preprocessing_key(recording_nwb_uri: str):
+    return {'type': 'spikeforest-recording-preprocessing', 'recording_nwb_uri': recording_nwb_uri}
+
+def get_recording_preprocessing(recording_nwb_uri: str) -> Union[List[dict], None]:
+    return kc.get(get_recording_preprocessing_key(recording_nwb_uri))
+
+def set_recording_preprocessing(recording_nwb_uri: str, preprocessing: List[dict]):
+    kc.set(get_recording_preprocessing_key(recording_nwb_uri), preprocessing)
+
+def sorter_applies_step(algorithm: str, sorting_params: dict, step_type: str):
+    p = sorter_preprocessing_params.get(algorithm, {}).get(step_type, None)
+    return p is not None and bool(sorting_params.get(p['flag'], False))
+
+def skip_applied_preprocessing(algorithm: str, sorting_params: dict, preprocessing: List[dict]):
+    # Returns sorting params with the sorter's own preprocessing switched off
+    # for steps already applied to the recording, and a description of each
+    # change. A sorter filter is only skipped if its band contains the band
+    # that was applied, so that filtering again would not change the data.
+    sorting_params = copy.deepcopy(sorting_params)
+    changes: List[str] = []
+    for step in preprocessing:
+        p = sorter_preprocessing_params.get(algorithm, {}).get(step['type'], None)
+        if p is None or not sorting_params.get(p['flag'], False):
+            continue
+        if step['type'] == 'bandpass_filter':
+            freq_min = sorting_params.get(p['freq_min'], None)
+            freq_max = sorting_params.get(p['freq_max'], None)
+            if freq_min is None or freq_max is None:
+                continue
+            if freq_min > step['freq_min'] or freq_max < step['freq_max']:
+                continue
+        sorting_params[p['flag']] = False
+        changes.append(f'{p["flag"]}: already applied ({step["type"]})')
+    return sorting_params, changes
@@ -3,7 +3,8 @@
 import click
 import json
 import yaml
-import kachery_client as kc
+from workflow_lists import load_workflow_results
+from async_kachery import get_async_client
 
 @click.command()
 @click.argument('config_file')
@@ -13,14 +14,15 @@ def main(config_file: str, json_format: str):
         config = yaml.safe_load(f)
     config_name = config['name']
     print(f'Config name: {config_name}')
-    results = kc.get({'type': 'spikeforest-workflow-results', 'name': config_name})
-    if results is None:
+    results = load_workflow_results(config_name)
+    if len(results) == 0:
         print('No results found.')
         return
     if json_format:
         print(json.dumps(results, indent=4))
     else:
-        for result in results:
+        comparisons = get_async_client().load_json_many([result['comparison_with_truth_uri'] for result in results])
+        for result, comparison_with_truth in zip(results, comparisons):
             recording = result['recording']
             sorter = result['sorter']
             recording_nwb_uri = result['recording_nwb_uri']
@@ -30,6 +32,7 @@ def main(config_file: str, json_format: str):
             sorting_console_lines_uri = result.get('sorting_console_lines_uri', None)
             comparison_with_truth_uri: dict = result['comparison_with_truth_uri']
             sorting_figurl = result.get('sorting_figurl', None)
+            sorter_agreement_uri = result.get('sorter_agreement_uri', None)
             print('==================================================================')
             print(f'RECORDING: {recording["studyName"]}/{recording["name"]}')
             print(f'SORTER: {sorter["name"]}')
@@ -39,8 +42,8 @@ def main(config_file: str, json_format: str):
             print(f'Sorting npz: {sorting_npz_uri}')
             print(f'Sorting console: {sorting_console_lines_uri}')
             print(f'Sorting figurl: {sorting_figurl}')
+            print(f'Sorter agreement: {sorter_agreement_uri}')
             print('')
-            comparison_with_truth = kc.load_json(comparison_with_truth_uri)
             if comparison_with_truth is not None:
                 for x in comparison_with_truth:
                     unit_id = x['unit_id']
@@ -3,23 +3,27 @@
 import os
 import click
 import yaml
-import kachery_client as kc
-import figurl
+from workflow_lists import load_workflow_results
+from async_kachery import get_async_client
 
 @click.command()
 @click.argument('config_file')
 def main(config_file: str):
     if not os.environ.get('FIGURL_CHANNEL'):
         raise Exception(f'Environment variable not set: FIGURL_CHANNEL')
+    import figurl
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
     config_name = config['name']
     print(f'Config name: {config_name}')
-    results = kc.get({'type': 'spikeforest-workflow-results', 'name': config_name})
-    for result in results:
-        result['comparison_with_truth'] = kc.load_json(result['comparison_with_truth_uri'])
-    for result in results:
-        result['sorting_true_metrics'] = kc.load_json(result['sorting_true_metrics_uri']) if result.get('sorting_true_metrics_uri') else None
+    results = load_workflow_results(config_name)
+    client = get_async_client()
+    comparisons = client.load_json_many([result['comparison_with_truth_uri'] for result in results])
+    metrics_uris = list(set([result['sorting_true_metrics_uri'] for result in results if result.get('sorting_true_metrics_uri')]))
+    metrics = dict(zip(metrics_uris, client.load_json_many(metrics_uris)))
+    for result, comparison in zip(results, comparisons):
+        result['comparison_with_truth'] = comparison
+        result['sorting_true_metrics'] = metrics[result['sorting_true_metrics_uri']] if result.get('sorting_true_metrics_uri') else None
     F = figurl.Figure(
         data={'type': 'spikeforest-workflow-results', 'results': results},
         view_url='gs://figurl/spikeforestview-1'
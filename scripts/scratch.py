@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Union
+import kachery_client as kc
+from output_store import get_output_scratch_dir
+
+# Places the temporary working directory of each job on the first (fastest)
+# configured scratch root that has room for it, and only admits the job once
+# some root has room. Roots are given, fastest first, by the
+# SPIKEFOREST_SCRATCH_ROOTS environment variable (separated by ':'); the
+# default is the directory next to kachery storage (see output_store.py),
+# or the system temporary directory.
+#
+# Each root has a ledger of the reservations of running jobs. Entries (and
+# directories) left behind by processes that no longer exist are removed
+# whenever a ledger is opened, so scratch is cleaned up after crashes. A root
+# may be shared between hosts: running jobs refresh a heartbeat in their
+# entry, and entries of other hosts whose heartbeat is stale are removed.
+
+# scratch space needed, as a multiple of the size of the job inputs, when
+# there is no history for a job type
+default_scratch_factors = {
+    'prepare-recording-nwb': 3.,
+    'sorting': 3.,
+    'whiten-recording-nwb': 2.,
+    'sorting-metrics': 1.5,
+    'compare-with-truth': 1.5,
+    'prepare-sorting-true-npz': 1.5,
+    'compare-sorters': 1.5,
+    'spike-trains': 2.
+}
+_min_scratch_bytes = 1e9
+_margin_factor = 1.2
+_monitor_interval_sec = 10
+_stale_heartbeat_sec = 600
+
+def get_scratch_roots() -> List[str]:
+    x = os.environ.get('SPIKEFOREST_SCRATCH_ROOTS', None)
+    if x:
+        return [r for r in x.split(':') if r]
+    scratch_dir = get_output_scratch_dir()
+    return [scratch_dir if scratch_dir is not None else tempfile.gettempdir()]
+
+def _get_history_key(job_type: str):
+    return {'type': 'spikeforest-scratch-history', 'job_type': job_type}
+
+def estimate_scratch_bytes(job_type: str, input_bytes: int) -> int:
+    # the largest recent ratio of peak scratch usage to input size, with a margin
+    history = kc.get(_get_history_key(job_type))
+    if history is not None and len(history['ratios']) > 0:
+        factor = max(history['ratios']) * _margin_factor
+    else:
+        factor = default_scratch_factors.get(job_type, 1.5)
+    return int(max(_min_scratch_bytes, factor * input_bytes))
+
+def _record_history(job_type: str, input_bytes: int, peak_bytes: int):
+    if input_bytes == 0:
+        return
+    key = _get_history_key(job_type)
+    history = kc.get(key) or {'ratios': []}
+    kc.set(key, {'ratios': (history['ratios'] + [peak_bytes / input_bytes])[-20:]})
+
+def _get_dir_bytes(path: str) -> int:
+    num_bytes = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fname in filenames:
+            try:
+                num_bytes += os.lstat(os.path.join(dirpath, fname)).st_size
+            except FileNotFoundError:
+                pass
+    return num_bytes
+
+def _pid_exists(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class _Ledger:
+    # reservations on one scratch root, locked with flock while open
+    def __init__(self, root: str) -> None:
+        self._root = root
+        self._dir = f'{root}/.spikeforest-scratch'
+        self._path = f'{self._dir}/reservations.json'
+    def __enter__(self):
+        os.makedirs(self._dir, exist_ok=True)
+        self._lock_file = open(f'{self._dir}/lock', 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        if os.path.exists(self._path):
+            with open(self._path, 'r') as f:
+                self.reservations: Dict[str, dict] = json.load(f)
+        else:
+            self.reservations = {}
+        self._cleanup()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        with open(f'{self._path}.tmp', 'w') as f:
+            json.dump(self.reservations, f)
+        os.replace(f'{self._path}.tmp', self._path)
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+    def available_bytes(self) -> int:
+        outstanding = sum([max(0, r['bytes'] - r['used_bytes']) for r in self.reservations.values()])
+        return shutil.disk_usage(self._root).free - outstanding
+    def _cleanup(self):
+        hostname = socket.gethostname()
+        for path, r in list(self.reservations.items()):
+            if r['host'] == hostname:
+                stale = not _pid_exists(r['pid'])
+            else:
+                stale = time.time() - r.get('heartbeat', 0) > _stale_heartbeat_sec
+            if stale:
+                print(f'Removing scratch directory of exited process {r["pid"]} on {r["host"]}: {path}')
+                shutil.rmtree(path, ignore_errors=True)
+                del self.reservations[path]
+        # directories of crashed jobs that were never recorded in the ledger
+        for name in os.listdir(self._root):
+            path = f'{self._root}/{name}'
+            parts = name.split('-')
+            if len(parts) >= 3 and parts[0] == 'job' and parts[1].isdigit() and path not in self.reservations:
+                pid = int(parts[1])
+                if name.startswith(f'job-{pid}-{hostname}-') and not _pid_exists(pid):
+                    shutil.rmtree(path, ignore_errors=True)
+
+class ScratchManager:
+    def __init__(self, roots: Union[List[str], None]=None, wait_timeout_sec: float=6 * 3600, poll_interval_sec: float=30) -> None:
+        self._roots = roots if roots is not None else get_scratch_roots()
+        self._wait_timeout_sec = wait_timeout_sec
+        self._poll_interval_sec = poll_interval_sec
+        self._usage: List[dict] = []
+    @contextmanager
+    def directory(self, job_type: str, input_bytes: int):
+        estimated_bytes = estimate_scratch_bytes(job_type, input_bytes)
+        root, path = self._admit(estimated_bytes)
+        usage = {'job_type': job_type, 'root': root, 'estimated_bytes': estimated_bytes, 'peak_bytes': 0}
+        done = threading.Event()
+        def _monitor():
+            while not done.wait(_monitor_interval_sec):
+                usage['peak_bytes'] = max(usage['peak_bytes'], _get_dir_bytes(path))
+                with _Ledger(root) as ledger:
+                    if path in ledger.reservations:
+                        ledger.reservations[path]['used_bytes'] = usage['peak_bytes']
+                        ledger.reservations[path]['heartbeat'] = time.time()
+        thread = threading.Thread(target=_monitor, daemon=True)
+        thread.start()
+        try:
+            yield path
+        finally:
+            done.set()
+            thread.join()
+            usage['peak_bytes'] = max(usage['peak_bytes'], _get_dir_bytes(path))
+            shutil.rmtree(path, ignore_errors=True)
+            with _Ledger(root) as ledger:
+                ledger.reservations.pop(path, None)
+            self._usage.append(usage)
+            _record_history(job_type, input_bytes, usage['peak_bytes'])
+            print(f'Scratch: {root}, estimated {estimated_bytes / 1e9:.2f} GB, peak {usage["peak_bytes"] / 1e9:.2f} GB')
+    @property
+    def usage(self) -> List[dict]:
+        return list(self._usage)
+    def add_usage(self, usage: List[dict]):
+        # usage of jobs run in other processes (e.g. pool workers)
+        self._usage.extend(usage)
+    def summary(self) -> str:
+        lines = ['SCRATCH USAGE:']
+        for root in self._roots:
+            x = [u for u in self._usage if u['root'] == root]
+            if len(x) == 0:
+                continue
+            lines.append(
+                f'{root}: {len(x)} jobs, '
+                f'max estimated {max([u["estimated_bytes"] for u in x]) / 1e9:.2f} GB, '
+                f'max peak {max([u["peak_bytes"] for u in x]) / 1e9:.2f} GB, '
+                f'free {shutil.disk_usage(root).free / 1e9:.2f} GB'
+            )
+        return '\n'.join(lines)
+    def _admit(self, estimated_bytes: int):
+        timer = time.time()
+        while True:
+            for root in self._roots:
+                os.makedirs(root, exist_ok=True)
+                with _Ledger(root) as ledger:
+                    if ledger.available_bytes() >= estimated_bytes:
+                        path = tempfile.mkdtemp(prefix=f'job-{os.getpid()}-{socket.gethostname()}-', dir=root)
+                        ledger.reservations[path] = {'pid': os.getpid(), 'host': socket.gethostname(), 'bytes': estimated_bytes, 'used_bytes': 0, 'heartbeat': time.time()}
+                        return root, path
+            if time.time() - timer > self._wait_timeout_sec:
+                raise Exception(f'Timed out waiting for {estimated_bytes / 1e9:.2f} GB of scratch space in: {", ".join(self._roots)}')
+            print(f'Waiting for {estimated_bytes / 1e9:.2f} GB of scratch space...')
+            time.sleep(self._poll_interval_sec)
+
+_manager: Union[ScratchManager, None] = None
+
+def get_scratch_manager() -> ScratchManager:
+    global _manager
+    if _manager is None:
+        _manager = ScratchManager()
+    return _manager
+
+def scratch_directory(job_type: str, input_bytes: int):
+    return get_scratch_manager().directory(job_type, input_bytes)
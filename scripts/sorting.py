@@ -6,10 +6,17 @@ import click
 import yaml
 import json
 from random import shuffle
-import runarepo
 from typing import List, Union
 import kachery_client as kc
 from Job import Job
+from async_kachery import get_async_client
+from workflow_lists import load_workflow_jobs
+from prefetch import Prefetcher
+from job_stats import record_job_stats
+from output_store import store_output_file
+from scratch import get_scratch_manager, scratch_directory
+from preprocessing import get_recording_preprocessing, set_recording_preprocessing
+from console_log import ConsoleLog, capture_console, get_console_log_key
 from multiprocessing import Pool
 from functools import partial
 
@@ -22,11 +29,28 @@ subpaths = {
     'kilosort2': 'kilosort2',
 }
 
-def _run_sorting_job(algorithm: str, recording_nwb_uri: str, sorting_params: dict, use_docker: bool=False, use_singularity: bool=False, image: Union[str, None]=None) -> dict:
-    with kc.TemporaryDirectory() as tmpdir:
+def _run_sorting_job(
+    algorithm: str,
+    recording_nwb_uri: str,
+    sorting_params: dict,
+    use_docker: bool=False,
+    use_singularity: bool=False,
+    image: Union[str, None]=None,
+    console_log_key: Union[dict, None]=None,
+    console_head_lines: int=1000,
+    console_tail_lines: int=1000,
+    console_max_bytes: int=100 * 1024 * 1024,
+    whiten_recording: bool=False
+) -> dict:
+    import runarepo
+    from spike_trains import store_spike_trains_for_npz
+    if whiten_recording:
+        # the workflow switched off whitening in the sorting params
+        recording_nwb_uri = _get_whitened_recording_nwb(recording_nwb_uri)
+    recording_nwb_path = kc.load_file(recording_nwb_uri)
+    assert recording_nwb_path is not None, f'Unable to load recording nwb: {recording_nwb_uri}'
+    with scratch_directory('sorting', os.path.getsize(recording_nwb_path)) as tmpdir:
         sorting_params_path = f'{tmpdir}/sorting_params.json'
-        recording_nwb_path = kc.load_file(recording_nwb_uri)
-        assert recording_nwb_path is not None, f'Unable to load recording nwb: {recording_nwb_uri}'
         output_dir = f'{tmpdir}/output'
 
         repo = os.environ.get('SPIKESORTING_RUNAREPO_PATH', 'https://github.com/scratchrealm/spikesorting-runarepo')
@@ -37,54 +61,107 @@ def _run_sorting_job(algorithm: str, recording_nwb_uri: str, sorting_params: dic
         with open(sorting_params_path, 'w') as f:
             json.dump(sorting_params, f)
 
-        print(f'Running {repo} {subpath}')
-        inputs = [
-            runarepo.Input(name='INPUT_RECORDING_NWB', path=recording_nwb_path),
-            runarepo.Input(name='INPUT_SORTING_PARAMS', path=sorting_params_path)
-        ]
-        output = runarepo.run(repo, subpath=subpath, inputs=inputs, output_dir=output_dir, use_docker=use_docker, use_singularity=use_singularity, image=image)
-        print(f'Storing console ouput')
-        console_lines_uri = kc.store_json(output.console_lines)
+        console_log = ConsoleLog(f'{tmpdir}/console.log.gz', head_lines=console_head_lines, tail_lines=console_tail_lines, max_bytes=console_max_bytes)
+        try:
+            if console_log_key is not None:
+                # so that the running job can be followed with tail_console.py
+                kc.set(console_log_key, {'path': console_log.path, 'pid': os.getpid()})
+
+            print(f'Running {repo} {subpath}')
+            inputs = [
+                runarepo.Input(name='INPUT_RECORDING_NWB', path=recording_nwb_path),
+                runarepo.Input(name='INPUT_SORTING_PARAMS', path=sorting_params_path)
+            ]
+            with capture_console(console_log):
+                output = runarepo.run(repo, subpath=subpath, inputs=inputs, output_dir=output_dir, use_docker=use_docker, use_singularity=use_singularity, image=image)
+            if console_log.num_lines < len(output.console_lines):
+                # the sorter output was not (fully) echoed while running
+                print(f'Using the console output returned by runarepo ({len(output.console_lines)} lines, {console_log.num_lines} captured)')
+                console_log.reset()
+                console_log.add_lines(output.console_lines)
+            console_log.close()
+            print(f'Storing console ouput ({console_log.num_lines} lines)')
+            console_lines_uri = console_log.store()
+        finally:
+            # also if the run fails, so that no live log is left behind
+            console_log.close()
+            if console_log_key is not None:
+                kc.delete(console_log_key)
         if output.retcode == 0:
             print('Storing sorting output...')
             sorting_npz_path = f'{output_dir}/sorting.npz'
-            sorting_npz_uri = kc.store_file(sorting_npz_path)
+            sorting_npz_uri = store_output_file(sorting_npz_path)
+            print('Storing sorting spike trains...')
+            sorting_spikes_uri = store_spike_trains_for_npz(sorting_npz_path, sorting_npz_uri)
         else:
             print(f'Nonzero exit code for sorting run: {output.retcode}')
             sorting_npz_uri = None
+            sorting_spikes_uri = None
         
         return {
             'retcode': output.retcode,
             'console_lines_uri': console_lines_uri,
-            'sorting_npz_uri': sorting_npz_uri
+            'sorting_npz_uri': sorting_npz_uri,
+            'sorting_spikes_uri': sorting_spikes_uri
         }
 
-def _run_sorting_jobs_wrapper(job: Job, config_name: str, verbose: bool, dry_run: bool, **kwargs):
+def _get_whitened_recording_nwb_key(recording_nwb_uri: str):
+    return {'type': 'spikeforest-whitened-recording-nwb', 'recording_nwb_uri': recording_nwb_uri}
+
+def _get_whitened_recording_nwb(recording_nwb_uri: str) -> str:
+    # created once per recording and shared by all sorters that whiten
+    key = _get_whitened_recording_nwb_key(recording_nwb_uri)
+    whitened_recording_nwb_uri = kc.get(key)
+    if whitened_recording_nwb_uri is not None and kc.load_file(whitened_recording_nwb_uri) is not None:
+        return whitened_recording_nwb_uri
+    import spikeinterface.extractors as se
+    from spikeinterface.toolkit.preprocessing import whiten
+    from nwb_conversion_tools.utils.spike_interface import write_recording
+    print('Creating whitened recording nwb...')
+    recording_nwb_path = kc.load_file(recording_nwb_uri)
+    assert recording_nwb_path is not None, f'Unable to load recording nwb: {recording_nwb_uri}'
+    with scratch_directory('whiten-recording-nwb', os.path.getsize(recording_nwb_path)) as tmpdir:
+        whitened_recording_nwb_path = f'{tmpdir}/recording_whitened.nwb'
+        recording = se.NwbRecordingExtractor(recording_nwb_path)
+        recording = whiten(recording, dtype='float32')
+        write_recording(recording, save_path=whitened_recording_nwb_path, compression=None, compression_opts=None)
+        whitened_recording_nwb_uri = store_output_file(whitened_recording_nwb_path)
+    preprocessing = get_recording_preprocessing(recording_nwb_uri)
+    if preprocessing is not None:
+        set_recording_preprocessing(whitened_recording_nwb_uri, preprocessing + [{'type': 'whiten'}])
+    kc.set(key, whitened_recording_nwb_uri)
+    return whitened_recording_nwb_uri
+
+def _run_sorting_jobs_wrapper(job: Job, config_name: str, verbose: bool, dry_run: bool, prefetcher: Union[Prefetcher, None]=None, **kwargs):
     job_key = _get_job_key(job.label, config_name)
     got_mutex = kc.set(job_key, os.getpid(), update=False)
     if not got_mutex:
         # unable to acquire mutex: someone else must have claimed this job, so we can skip it
         if (verbose): print(f"\tUnable to get lock {job_key}, skipping.")
-        return
+        return []
     if (verbose): print(f"\tGot lock for job {job_key}")
+    if prefetcher is not None:
+        prefetcher.wait(job)
+    # the scratch usage of this job is returned, for the summary of a parallel run
+    num_usage = len(get_scratch_manager().usage)
     print(f'Running: {job.label}')
     if (not dry_run):
-        output = _run_sorting_job(**job.kwargs, **kwargs)
+        with record_job_stats(job, measure_memory=not kwargs['use_docker']):
+            output = _run_sorting_job(**job.kwargs, **kwargs, console_log_key=get_console_log_key(config_name, job.label))
         kc.set(job.key(), output)
     else:
         output = "DRY RUN: JOB SKIPPED"
     print(f'OUTPUT of {job.label}:\n{output}')
+    return get_scratch_manager().usage[num_usage:]
 
 def _get_job_key(label: str, config_name: str):
     return f"{config_name}-running-sorting-{label}"
 
 def _reset_locks(jobs: List[Job], config_name: str):
-    locks_reset = 0
-    for job in jobs:
-        job_key = _get_job_key(job.label, config_name)
-        if (kc.get(job_key) is not None):
-            locks_reset += 1
-        kc.delete(job_key)
+    job_keys = [_get_job_key(job.label, config_name) for job in jobs]
+    client = get_async_client()
+    locks_reset = len([x for x in client.get_many(job_keys) if x is not None])
+    client.delete_many(job_keys)
     return locks_reset
 
 def _init_config(config_file: str, docker: bool, singularity: bool, num_parallel: Union[str, None]=None):
@@ -100,8 +177,7 @@ def _init_config(config_file: str, docker: bool, singularity: bool, num_parallel
     return (config_name, docker, singularity, num_parallel)
 
 def _get_jobs_list(config_name: str, algorithm: str):
-    jobs_dict = kc.get({'type': 'spikeforest-workflow-jobs', 'name': config_name})
-    jobs: List[Job] = [Job.from_dict(job_dict) for job_dict in jobs_dict]
+    jobs: List[Job] = load_workflow_jobs(config_name)
     #### TODO: Should this 'algorithm' actually be 'name'?
     jobs = [job for job in jobs if job.type == 'sorting' and job.kwargs['algorithm'] == algorithm]
     return jobs
@@ -111,8 +187,8 @@ def _filter_jobs_to_run(all_jobs: List[Job], force_run: bool, rerun_failing: boo
         return all_jobs
 
     jobs: List[Job] = []
-    for job in all_jobs:
-        key = kc.get(job.key())
+    outputs = get_async_client().get_many([job.key() for job in all_jobs])
+    for job, key in zip(all_jobs, outputs):
         if job.force_run or (key is None) or (key['sorting_npz_uri'] is None and rerun_failing):
             jobs.append(job)
     return jobs
@@ -140,6 +216,11 @@ def _describe_jobs_to_run(jobs: List[Job], num_parallel: int):
 @click.option('--use-deterministic-job-order', is_flag=True, help="If unset, will skip shuffling the order of jobs")
 @click.option('--dry-run', is_flag=True, help="If set, sorters won't actually be called.")
 @click.option('--verbose', is_flag=True, help="Detailed output about steps taken")
+@click.option('--prefetch', default=2, help="Number of upcoming jobs whose inputs are fetched in the background (0 to disable)")
+@click.option('--prefetch-disk-budget-gb', default=50., help="Maximum size of prefetched inputs not yet used")
+@click.option('--console-head-lines', default=1000, help="Number of lines kept from the start of the sorter console output")
+@click.option('--console-tail-lines', default=1000, help="Number of lines kept from the end of the sorter console output")
+@click.option('--console-max-bytes', default=100 * 1024 * 1024, help="Maximum size of the live console log")
 def main(
     config_file: str,
     algorithm: str,
@@ -152,7 +233,12 @@ def main(
     image: Union[str, None],
     use_deterministic_job_order: bool,
     dry_run: bool,
-    verbose: bool
+    verbose: bool,
+    prefetch: int,
+    prefetch_disk_budget_gb: float,
+    console_head_lines: int,
+    console_tail_lines: int,
+    console_max_bytes: int
 ):
     (config_name, docker, singularity, num_parallel) = _init_config(config_file, docker, singularity, num_parallel)
     all_matched_jobs = _get_jobs_list(config_name, algorithm)
@@ -168,16 +254,56 @@ def main(
     _describe_jobs_to_run(jobs_to_run, num_parallel)
 
     # Curry the command line parameters so we can just pass the Job object later on.
-    run_sorting_job_partial = partial(_run_sorting_jobs_wrapper, use_docker=docker, use_singularity=singularity, image=image, config_name=config_name, dry_run=dry_run, verbose=verbose)
+    run_sorting_job_partial = partial(_run_sorting_jobs_wrapper, use_docker=docker, use_singularity=singularity, image=image, config_name=config_name, dry_run=dry_run, verbose=verbose, console_head_lines=console_head_lines, console_tail_lines=console_tail_lines, console_max_bytes=console_max_bytes)
 
+    # Fetch the recordings of upcoming jobs while the current ones run. Jobs
+    # that another process has locked are not prefetched (the serial path
+    # prefetches the job it has just locked itself).
+    def get_input_uris(job: Job):
+        lock = kc.get(_get_job_key(job.label, config_name))
+        if lock is not None and lock != os.getpid():
+            return []
+        return [job.kwargs['recording_nwb_uri']]
+    prefetcher: Union[Prefetcher, None] = None
     if (num_parallel == 1):
+        if not dry_run:
+            prefetcher = Prefetcher(jobs_to_run, get_input_uris, lookahead=prefetch, disk_budget_bytes=prefetch_disk_budget_gb * 1e9)
         for job in jobs_to_run:
-            run_sorting_job_partial(job)
+            # the wrapper waits for the inputs once it holds the job lock
+            run_sorting_job_partial(job, prefetcher=prefetcher)
+            if prefetcher is not None:
+                prefetcher.release(job)
+        if len(jobs_to_run) > 0:
+            print(get_scratch_manager().summary())
     else:
+        # Prefetch ahead of the workers, handing out jobs one at a time and
+        # only once their inputs are in the local store, so that they start
+        # in list order and do not fetch the same file as the prefetcher (the
+        # pool is created first, so that the workers are not forked from a
+        # process with running fetch threads). The waiting happens in the
+        # pool's task thread, so the wait reported also includes time when
+        # all workers were busy.
         pool = Pool(num_parallel)
-        list(pool.imap(run_sorting_job_partial, jobs_to_run, chunksize=max(1, len(jobs_to_run)//num_parallel)))
+        if not dry_run and prefetch > 0:
+            prefetcher = Prefetcher(jobs_to_run, get_input_uris, lookahead=prefetch + num_parallel, disk_budget_bytes=prefetch_disk_budget_gb * 1e9)
+        def _prefetched_jobs():
+            for job in jobs_to_run:
+                if prefetcher is not None:
+                    prefetcher.wait(job)
+                yield job
+        chunksize = 1 if prefetcher is not None else max(1, len(jobs_to_run)//num_parallel)
+        for i, usage in enumerate(pool.imap(run_sorting_job_partial, _prefetched_jobs(), chunksize=chunksize)):
+            if prefetcher is not None:
+                prefetcher.release(jobs_to_run[i])
+            get_scratch_manager().add_usage(usage)
         pool.close()
         pool.join()
+        if len(jobs_to_run) > 0:
+            print(get_scratch_manager().summary())
+    if prefetcher is not None:
+        prefetcher.shutdown()
+        if prefetch > 0:
+            print(prefetcher.report())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,23 +1,27 @@
 #!/usr/bin/env python3
 
-import numpy as np
 import click
 import yaml
 from typing import List, Union
 import kachery_client as kc
 from Job import Job
-from spikeinterface import extractors as se
-from spikeinterface.core.old_api_utils import NewToOldSorting
-import sortingview as sv
-from sortingview.SpikeSortingView import SpikeSortingView, create_console_view, create_raw_traces_plot
+from async_kachery import get_async_client
+from workflow_lists import load_workflow_jobs
+from job_stats import record_job_stats
+from console_log import load_console_lines
 
 def _run_sorting_figurl(recording_nwb_uri: str, sorting_npz_uri: str, label: str, sorting_console_lines_uri: Union[str, None]=None) -> dict:
+    import numpy as np
+    import sortingview as sv
+    from sortingview.SpikeSortingView import SpikeSortingView, create_console_view, create_raw_traces_plot
+    from spikeinterface.core.old_api_utils import NewToOldSorting
+    from spike_trains import load_spike_trains
+    from spike_trains_sorting import SpikeTrainsSortingExtractor
     recording_nwb = kc.load_file(recording_nwb_uri)
     assert recording_nwb is not None, f'Unable to load file: {recording_nwb_uri}'
-    sorting_npz = kc.load_file(sorting_npz_uri)
-    assert sorting_npz is not None, f'Unable to load file: {sorting_npz_uri}'
+    spike_trains = load_spike_trains(sorting_npz_uri)
     if sorting_console_lines_uri is not None:
-        sorting_console_lines = kc.load_json(sorting_console_lines_uri)
+        sorting_console_lines = load_console_lines(sorting_console_lines_uri)
         if sorting_console_lines is None: f'Warning: Unable to load sorting console: {sorting_console_lines_uri}'
     else:
         sorting_console_lines = None
@@ -28,7 +32,7 @@ def _run_sorting_figurl(recording_nwb_uri: str, sorting_npz_uri: str, label: str
             'path': recording_nwb
         }
     })
-    sorting = NewToOldSorting(se.NpzSortingExtractor(sorting_npz))
+    sorting = NewToOldSorting(SpikeTrainsSortingExtractor(spike_trains))
     sorting = sv.LabboxEphysSortingExtractor.from_memory(sorting=sorting, serialize=True)
 
     print('Preparing spikesortingview data')
@@ -91,12 +95,12 @@ def main(config_file: str, force_run: bool):
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
     config_name = config['name']
-    jobs0 = kc.get({'type': 'spikeforest-workflow-jobs', 'name': config_name})
-    jobs: List[Job] = [Job.from_dict(job0) for job0 in jobs0]
+    jobs: List[Job] = load_workflow_jobs(config_name)
     jobs = [job for job in jobs if job.type == 'sorting-figurl']
+    outputs = get_async_client().get_many([job.key() for job in jobs]) if not force_run else [None] * len(jobs)
     jobs_to_run = [
-        job for job in jobs
-        if force_run or job.force_run or (kc.get(job.key()) is None)
+        job for job, output in zip(jobs, outputs)
+        if force_run or job.force_run or (output is None)
     ]
     print('JOBS TO RUN:')
     for job in jobs_to_run:
@@ -108,7 +112,8 @@ def main(config_file: str, force_run: bool):
 
     for job in jobs_to_run:
         print(f'Running: {job.label}')
-        output = _run_sorting_figurl(**job.kwargs)
+        with record_job_stats(job):
+            output = _run_sorting_figurl(**job.kwargs)
         print('OUTPUT')
         print(output)
         kc.set(job.key(), output)
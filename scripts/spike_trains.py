@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+from typing import Any, List, Union
+import kachery_client as kc
+from output_store import store_output_file
+from scratch import scratch_directory
+
+# Columnar spike-train container, stored next to sorting.npz. Unlike the npz
+# it can be opened with np.memmap without decompressing or copying.
+#
+# Layout:
+#     magic (8 bytes) | header length (uint64) | JSON header | arrays
+# Each array starts at a 64-byte aligned offset given in the header:
+#     spike_times       int64, all spikes sorted by time
+#     spike_labels      int32, unit index of each spike in spike_times
+#     unit_spike_times  int64, spikes grouped by unit, sorted within each unit
+#     unit_offsets      int64, unit i occupies unit_spike_times[unit_offsets[i]:unit_offsets[i + 1]]
+
+_magic = b'SFSPIKE1'
+_alignment = 64
+
+class SpikeTrains:
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            magic = f.read(len(_magic))
+            if magic != _magic:
+                raise Exception(f'Not a spike trains file: {path}')
+            header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        self._path = path
+        self._header = header
+        self._unit_ids: List[Any] = header['unit_ids']
+        self._unit_indices = {unit_id: i for i, unit_id in enumerate(self._unit_ids)}
+        self._arrays = {
+            name: np.memmap(path, dtype=a['dtype'], mode='r', offset=a['offset'], shape=(a['length'],))
+            if a['length'] > 0 else np.zeros((0,), dtype=a['dtype'])
+            for name, a in header['arrays'].items()
+        }
+    @property
+    def path(self):
+        return self._path
+    @property
+    def sampling_frequency(self) -> float:
+        return self._header['sampling_frequency']
+    @property
+    def unit_ids(self):
+        return list(self._unit_ids)
+    @property
+    def num_spikes(self) -> int:
+        return self._header['num_spikes']
+    @property
+    def spike_times(self) -> np.ndarray:
+        return self._arrays['spike_times']
+    @property
+    def spike_labels(self) -> np.ndarray:
+        return self._arrays['spike_labels']
+    def get_unit_index(self, unit_id) -> int:
+        return self._unit_indices[unit_id]
+    def get_unit_spike_train(self, unit_id, start_frame: Union[int, None]=None, end_frame: Union[int, None]=None) -> np.ndarray:
+        i = self._unit_indices[unit_id]
+        unit_offsets = self._arrays['unit_offsets']
+        times = self._arrays['unit_spike_times'][unit_offsets[i]:unit_offsets[i + 1]]
+        i1, i2 = _get_frame_range(times, start_frame, end_frame)
+        return times[i1:i2]
+    def get_spikes(self, start_frame: Union[int, None]=None, end_frame: Union[int, None]=None):
+        # spike times and unit indices of all spikes in [start_frame, end_frame)
+        i1, i2 = _get_frame_range(self._arrays['spike_times'], start_frame, end_frame)
+        return self._arrays['spike_times'][i1:i2], self._arrays['spike_labels'][i1:i2]
+
+def _get_frame_range(times: np.ndarray, start_frame: Union[int, None], end_frame: Union[int, None]):
+    i1 = int(np.searchsorted(times, start_frame, side='left')) if start_frame is not None else 0
+    i2 = int(np.searchsorted(times, end_frame, side='left')) if end_frame is not None else len(times)
+    return i1, i2
+
+def write_spike_trains(path: str, *, sampling_frequency: float, unit_ids: list, spike_times: np.ndarray, spike_labels: np.ndarray):
+    # spike_labels are unit ids (as in sorting.npz)
+    unit_ids = [_to_json_scalar(u) for u in unit_ids]
+    unit_indices = {unit_id: i for i, unit_id in enumerate(unit_ids)}
+    spike_times = np.asarray(spike_times, dtype=np.int64)
+    unique_labels, inverse = np.unique(np.asarray(spike_labels), return_inverse=True)
+    label_map = np.array([unit_indices[_to_json_scalar(u)] for u in unique_labels], dtype=np.int32)
+    spike_label_indices = label_map[inverse.ravel()]
+
+    time_order = np.argsort(spike_times, kind='stable')
+    unit_order = np.lexsort((spike_times, spike_label_indices))
+    counts = np.bincount(spike_label_indices, minlength=len(unit_ids))
+    arrays = {
+        'spike_times': spike_times[time_order],
+        'spike_labels': spike_label_indices[time_order],
+        'unit_spike_times': spike_times[unit_order],
+        'unit_offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    }
+
+    header = {
+        'sampling_frequency': float(sampling_frequency),
+        'unit_ids': unit_ids,
+        'num_spikes': int(len(spike_times)),
+        'arrays': {}
+    }
+    # the header size depends on the offsets, so reserve space generously
+    header_space = _align(len(json.dumps({**header, 'arrays': {name: {'dtype': 'int64', 'offset': 10 ** 15, 'length': 10 ** 15} for name in arrays}}).encode('utf-8')) + len(_magic) + 8)
+    offset = header_space
+    for name, a in arrays.items():
+        header['arrays'][name] = {'dtype': a.dtype.newbyteorder('<').str, 'offset': offset, 'length': int(len(a))}
+        offset = _align(offset + a.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(_magic)
+        f.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+        f.write(header_bytes)
+        for name, a in arrays.items():
+            f.seek(header['arrays'][name]['offset'])
+            f.write(a.astype(header['arrays'][name]['dtype'], copy=False).tobytes())
+
+def convert_npz_to_spike_trains(npz_path: str, path: str):
+    # npz as written by spikeinterface NpzSortingExtractor.write_sorting
+    npz = np.load(npz_path)
+    num_segment = int(npz['num_segment'][0])
+    if num_segment != 1:
+        raise Exception(f'Unsupported number of segments in {npz_path}: {num_segment}')
+    write_spike_trains(
+        path,
+        sampling_frequency=float(npz['sampling_frequency'][0]),
+        unit_ids=list(npz['unit_ids']),
+        spike_times=npz['spike_indexes_seg0'],
+        spike_labels=npz['spike_labels_seg0']
+    )
+
+def get_spike_trains_key(sorting_npz_uri: str):
+    return {'type': 'spikeforest-spike-trains', 'sorting_npz_uri': sorting_npz_uri}
+
+def store_spike_trains_for_npz(sorting_npz_path: str, sorting_npz_uri: str) -> str:
+    with scratch_directory('spike-trains', os.path.getsize(sorting_npz_path)) as tmpdir:
+        path = f'{tmpdir}/sorting.spikes'
+        convert_npz_to_spike_trains(sorting_npz_path, path)
+        spike_trains_uri = store_output_file(path)
+    kc.set(get_spike_trains_key(sorting_npz_uri), spike_trains_uri)
+    return spike_trains_uri
+
+def load_spike_trains(sorting_npz_uri: str) -> SpikeTrains:
+    # Prefer the spike trains container; create it from the npz if it was
+    # not produced by the stage that created the npz
+    spike_trains_uri = kc.get(get_spike_trains_key(sorting_npz_uri))
+    path = kc.load_file(spike_trains_uri) if spike_trains_uri is not None else None
+    if path is None:
+        sorting_npz_path = kc.load_file(sorting_npz_uri)
+        assert sorting_npz_path is not None, f'Unable to load: {sorting_npz_uri}'
+        spike_trains_uri = store_spike_trains_for_npz(sorting_npz_path, sorting_npz_uri)
+        path = kc.load_file(spike_trains_uri)
+        assert path is not None, f'Unable to load: {spike_trains_uri}'
+    return SpikeTrains(path)
+
+def _align(x: int):
+    return ((x + _alignment - 1) // _alignment) * _alignment
+
+def _to_json_scalar(x):
+    return x.item() if isinstance(x, np.generic) else x
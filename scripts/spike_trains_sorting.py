@@ -0,0 +1,17 @@
+from spikeinterface.core import BaseSorting, BaseSortingSegment
+from spike_trains import SpikeTrains
+
+# spikeinterface sorting extractor backed by a (memory-mapped) spike trains file
+
+class SpikeTrainsSortingExtractor(BaseSorting):
+    def __init__(self, spike_trains: SpikeTrains):
+        BaseSorting.__init__(self, sampling_frequency=spike_trains.sampling_frequency, unit_ids=spike_trains.unit_ids)
+        self.add_sorting_segment(SpikeTrainsSortingSegment(spike_trains))
+        self._kwargs = {'path': spike_trains.path}
+
+class SpikeTrainsSortingSegment(BaseSortingSegment):
+    def __init__(self, spike_trains: SpikeTrains):
+        BaseSortingSegment.__init__(self)
+        self._spike_trains = spike_trains
+    def get_unit_spike_train(self, unit_id, start_frame, end_frame):
+        return self._spike_trains.get_unit_spike_train(unit_id, start_frame=start_frame, end_frame=end_frame)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import importlib
+import click
+
+# Single entry point for all the stages. The module implementing a
+# subcommand is only imported when that subcommand is invoked, and the stage
+# modules import their heavy dependencies (spikeinterface, sortingview,
+# nwb_conversion_tools, runarepo, figurl) inside the functions that run jobs,
+# so status queries and lock management start quickly.
+
+# subcommand name -> (module, short help)
+subcommands = {
+    'workflow': ('workflow', 'Assemble the jobs and results for a config'),
+    'plan': ('plan', 'Predict makespan, peak memory and critical path for a config'),
+    'prepare-recording-nwb': ('prepare_recording_nwb', 'Prepare the recording nwb files'),
+    'prepare-sorting-true-npz': ('prepare_sorting_true_npz', 'Prepare the ground-truth sorting npz files'),
+    'sorting': ('sorting', 'Run the spike sorting jobs for an algorithm'),
+    'sorting-metrics': ('sorting_metrics', 'Compute metrics of the ground-truth sortings'),
+    'compare-with-truth': ('compare_with_truth', 'Compare the sortings with ground truth'),
+    'compare-sorters': ('compare_sorters', 'Compute the agreement between sorters for each recording'),
+    'sorting-figurl': ('sorting_figurl', 'Create figurl views of the sortings'),
+    'print-results': ('print_results', 'Print the workflow results'),
+    'results-figurl': ('results_figurl', 'Create a figurl view of the workflow results'),
+    'tail-console': ('tail_console', 'Print or follow the console output of a sorting job')
+}
+
+class LazyGroup(click.Group):
+    def list_commands(self, ctx):
+        return list(subcommands.keys())
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in subcommands:
+            return None
+        module_name, _ = subcommands[cmd_name]
+        return importlib.import_module(module_name).main
+    def format_commands(self, ctx, formatter):
+        # use the short help above, rather than importing every module
+        with formatter.section('Commands'):
+            formatter.write_dl([(name, short_help) for name, (_, short_help) in subcommands.items()])
+
+@click.group(cls=LazyGroup)
+def main():
+    """SpikeForest workflow"""
+    pass
+
+if __name__ == '__main__':
+    main()
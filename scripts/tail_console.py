@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import click
+import yaml
+from typing import List
+import kachery_client as kc
+from Job import Job
+from workflow_lists import load_workflow_jobs
+from console_log import ConsoleLogReader, get_console_log_key, load_console_lines
+
+def _print_stored_console(config_name: str, label: str, num_lines: int):
+    jobs: List[Job] = load_workflow_jobs(config_name)
+    jobs = [job for job in jobs if job.type == 'sorting' and job.label == label]
+    if len(jobs) == 0:
+        print(f'No sorting job found: {label}')
+        return
+    output = kc.get(jobs[0].key())
+    console_lines_uri = output.get('console_lines_uri', None) if output is not None else None
+    if console_lines_uri is None:
+        print(f'No console output found for job: {label}')
+        return
+    console_lines = load_console_lines(console_lines_uri)
+    if console_lines is None:
+        print(f'Unable to load console output: {console_lines_uri}')
+        return
+    for line in console_lines[-num_lines:]:
+        print(line)
+
+@click.command()
+@click.argument('config_file')
+@click.argument('label')
+@click.option('--follow', '-f', is_flag=True, help="Keep printing output until the job finishes")
+@click.option('--num-lines', '-n', default=100, help="Number of lines to print from a finished job")
+def main(config_file: str, label: str, follow: bool, num_lines: int):
+    """Print the console output of a sorting job, identified by its label (e.g. "mountainsort4 paired_kampff/2014_11_25_Pair_3_0").
+
+    Running jobs can only be followed from the machine where they run.
+    """
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    config_name = config['name']
+    console_log_key = get_console_log_key(config_name, label)
+    x = kc.get(console_log_key)
+    if x is None or not os.path.exists(x['path']):
+        _print_stored_console(config_name, label, num_lines)
+        return
+    reader = ConsoleLogReader(x['path'])
+    while True:
+        # check before reading, so that the last read picks up everything
+        finished = follow and kc.get(console_log_key) is None
+        try:
+            text = reader.read()
+        except FileNotFoundError:
+            # the job finished and its scratch directory was removed
+            break
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        if not follow or finished:
+            break
+        time.sleep(1)
+
+if __name__ == '__main__':
+    main()
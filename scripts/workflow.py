@@ -2,131 +2,259 @@
 
 import click
 import yaml
-from typing import List, Union
+from typing import Dict, List, Union
 import kachery_client as kc
 from Job import Job
+from async_kachery import get_async_client
+from workflow_lists import get_item_id, publish_lock, publish_workflow_list_delta
+from preprocessing import recording_nwb_preprocessing, skip_applied_preprocessing, sorter_applies_step
 
+# spikeforest study sets data
+sf_study_sets_uri = 'sha1://f728d5bf1118a8c6e2dfee7c99efb0256246d1d3/studysets.json'
 
 class Workflow:
-    def __init__(self) -> None:
+    def __init__(self, settled_outputs: Union[Dict[str, dict], None]=None) -> None:
         self._jobs: List[Job] = []
         self._results: List[dict] = []
+        self._previously_settled_outputs = settled_outputs if settled_outputs is not None else {}
+        self._settled_outputs: Dict[str, dict] = {}
     def add_job(self, job: Job):
         self._jobs.append(job)
     def add_result(self, result: dict):
         self._results.append(result)
+    def get_output(self, job: Job, uri_fields: List[str]):
+        # The output of the job, with the URIs that are not in the local store
+        # set to None. An output whose URIs were all found is settled: it is
+        # kept in the plan, and later runs only check that it was not replaced
+        # (see _recheck_settled_outputs).
+        job_id = get_item_id(job.key())
+        output = self._previously_settled_outputs.get(job_id, None)
+        if output is None:
+            output = kc.get(job.key())
+            if output is None:
+                return None
+            output = dict(output)
+            for field in uri_fields:
+                uri = output.get(field, None)
+                if not uri or kc.load_file(uri, local_only=True) is None:
+                    output[field] = None
+            if any([output[field] is None for field in uri_fields]):
+                return output
+        self._settled_outputs[job_id] = output
+        return output
+    def is_settled(self, job: Job):
+        return get_item_id(job.key()) in self._settled_outputs
     @property
     def jobs(self):
         return self._jobs.copy()
     @property
     def results(self):
         return self._results.copy()
+    @property
+    def settled_outputs(self):
+        return dict(self._settled_outputs)
+
+def _get_plan_key(config_name: str):
+    return {'type': 'spikeforest-workflow-plan', 'name': config_name}
+
+def _get_entry_fingerprint(config_study: dict, recording_name: str, sorters: List[dict]):
+    return get_item_id({
+        'sf_study_sets_uri': sf_study_sets_uri,
+        'study_set_name': config_study['study_set_name'],
+        'study_name': config_study['study_name'],
+        'recording_name': recording_name,
+        'sorters': sorters
+    })
+
+def _recheck_settled_outputs(previous_datas: Dict[str, dict]):
+    # The settled outputs of the previous plan that are still the stored
+    # outputs of their jobs, by entry. They are all re-read in one batch, so
+    # that jobs that were rerun since (e.g. with --force-run) are picked up.
+    settled: List[tuple] = []
+    for entry_id, previous_data in previous_datas.items():
+        for x in previous_data['jobs']:
+            job = Job.from_dict(x)
+            job_id = get_item_id(job.key())
+            if job_id in previous_data['settled_outputs']:
+                settled.append((entry_id, job_id, job))
+    outputs = get_async_client().get_many([job.key() for _, _, job in settled])
+    settled_outputs: Dict[str, Dict[str, dict]] = {entry_id: {} for entry_id in previous_datas}
+    for (entry_id, job_id, _), output in zip(settled, outputs):
+        if output == previous_datas[entry_id]['settled_outputs'][job_id]:
+            settled_outputs[entry_id][job_id] = output
+    return settled_outputs
 
 @click.command()
 @click.argument('config_file')
-def main(config_file: str):
+@click.option('--full', is_flag=True, help="Re-evaluate every entry and re-check every job output, ignoring the previous plan")
+def main(config_file: str, full: bool):
     # Load configuration file
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
     config_name = config['name']
-    config_sorters = config['sorters']
-    config_studies = config['studies']
-
-    # Load spikeforest study sets data
-    sf_study_sets_uri = 'sha1://f728d5bf1118a8c6e2dfee7c99efb0256246d1d3/studysets.json'
-    sf_study_sets = kc.load_json(sf_study_sets_uri)
-    assert sf_study_sets is not None, f'Unable to load sf study sets: {sf_study_sets_uri}'
-
-    # Initialize the workflow
-    workflow = Workflow()
-
-    for config_study in config_studies: # for each study
-        # Get the sorters to be run for this study
-        sorters0: List[dict] = []
-        for sorter_name in config_study['sorter_names']:
-            x = [s for s in config_sorters if s['name'] == sorter_name]
-            if len(x) == 0:
-                raise Exception(f'Sorter not found in config: {sorter_name}')
-            assert len(x) == 1, f'Unexpected: duplicate sorter found in config: {sorter_name}'
-            sorters0.append(x[0])
-        for recording_name in config_study['recording_names']: # for each recording
-            # load the recording dict from the spikeforest study sets
-            recording = _get_spikeforest_recording(sf_study_sets, config_study['study_set_name'], config_study['study_name'], recording_name)
-            # prepare recording.nwb
-            recording_nwb_uri = _prepare_recording_nwb(workflow, recording)
-            # prepare sorting_true.npz
-            sorting_true_npz_uri = _prepare_sorting_true_npz(workflow, recording)
-
-            # sorting true metrics
-            sorting_true_metrics_uri = _sorting_metrics(workflow, recording, recording_nwb_uri, sorting_true_npz_uri)
-
-            for sorter in sorters0: # for each sorter
-                # do the spike sorting for the given sorter
-                sorting_out = _sorting(workflow, recording, recording_nwb_uri, sorter)
-                if sorting_out is not None:
-                    sorting_npz_uri = sorting_out['sorting_npz_uri']
-                    sorting_console_lines_uri = sorting_out['console_lines_uri']
-                else:
-                    sorting_npz_uri = None
-                    sorting_console_lines_uri = None
-                # sorting figurl
-                sorting_figurl = _get_sorting_figurl(workflow, recording, sorter, recording_nwb_uri, sorting_npz_uri, sorting_console_lines_uri)
-                # compare with truth
-                comparison_uri = _compare_with_truth(workflow, recording, sorter, sorting_npz_uri, sorting_true_npz_uri)
-                if sorting_npz_uri is not None and comparison_uri is not None and kc.load_file(comparison_uri, local_only=True) is not None:
-                    # if everything has completed for this recording/sorter, add the result to the workflow
-                    workflow.add_result({
-                        'recording': recording,
-                        'sorter': sorter,
-                        'recording_nwb_uri': recording_nwb_uri,
-                        'sorting_true_npz_uri': sorting_true_npz_uri,
-                        'sorting_true_metrics_uri': sorting_true_metrics_uri,
-                        'sorting_npz_uri': sorting_npz_uri,
-                        'sorting_console_lines_uri': sorting_console_lines_uri,
-                        'comparison_with_truth_uri': comparison_uri,
-                        'sorting_figurl': sorting_figurl
-                    })
-    # Set the list of jobs as a kachery mutable
-    kc.set({'type': 'spikeforest-workflow-jobs', 'name': config_name}, [job.to_dict() for job in workflow.jobs])
-    # Set the list of results as a kachery mutable
-    kc.set({'type': 'spikeforest-workflow-results', 'name': config_name}, workflow.results)
+
+    # planning and publishing are serialized between concurrent runs
+    with publish_lock(config_name):
+        # The previous plan: for each entry (a recording of a study, with its
+        # sorters) the fingerprint of its config, whether all of its jobs were
+        # settled, and the stored jobs, results and settled outputs. An entry is
+        # only re-evaluated if its config changed or some of its jobs were not
+        # settled (or no longer are), and then only the jobs that were not
+        # settled are checked.
+        previous_plan = kc.get(_get_plan_key(config_name))
+        previous_entries: Dict[str, dict] = previous_plan['entries'] if previous_plan is not None else {}
+        previous_datas: Dict[str, dict] = {}
+        for entry_id, previous_data in zip(previous_entries.keys(), get_async_client().load_json_many([e['uri'] for e in previous_entries.values()])):
+            assert previous_data is not None, f'Unable to load previous plan entry: {previous_entries[entry_id]["uri"]}'
+            previous_datas[entry_id] = previous_data
+        settled_outputs = _recheck_settled_outputs(previous_datas) if not full else {}
+
+        sf_study_sets: Union[dict, None] = None
+        entries: Dict[str, dict] = {}
+        added_jobs: List[dict] = []
+        removed_job_ids: List[str] = []
+        added_results: List[dict] = []
+        removed_result_ids: List[str] = []
+        evaluated_jobs: List[tuple] = []
+        num_evaluated = 0
+        for entry_id, config_study, recording_name, sorters0 in get_config_entries(config): # for each recording
+            fingerprint = _get_entry_fingerprint(config_study, recording_name, sorters0)
+            previous_entry = previous_entries.get(entry_id, None)
+            previous_data = previous_datas.get(entry_id, None)
+            entry_settled_outputs = settled_outputs.get(entry_id, None)
+            if previous_entry is not None and previous_entry['fingerprint'] == fingerprint and previous_entry['complete'] and not full:
+                if len(entry_settled_outputs) == len(previous_data['settled_outputs']):
+                    entries[entry_id] = previous_entry
+                    continue
+            if sf_study_sets is None:
+                # Load spikeforest study sets data
+                sf_study_sets = kc.load_json(sf_study_sets_uri)
+                assert sf_study_sets is not None, f'Unable to load sf study sets: {sf_study_sets_uri}'
+            workflow = Workflow(settled_outputs=entry_settled_outputs)
+            _add_recording_jobs(workflow, sf_study_sets, config_study, recording_name, sorters0)
+            data = {
+                'jobs': [job.to_dict() for job in workflow.jobs],
+                'results': workflow.results,
+                'settled_outputs': workflow.settled_outputs
+            }
+            entries[entry_id] = {
+                'fingerprint': fingerprint,
+                'complete': all([workflow.is_settled(job) for job in workflow.jobs]),
+                'uri': kc.store_json(data)
+            }
+            a, r = _diff_items(previous_data['jobs'] if previous_data is not None else [], data['jobs'])
+            added_jobs.extend(a)
+            removed_job_ids.extend(r)
+            a, r = _diff_items(previous_data['results'] if previous_data is not None else [], data['results'])
+            added_results.extend(a)
+            removed_result_ids.extend(r)
+            evaluated_jobs.extend([(job, workflow.is_settled(job)) for job in workflow.jobs])
+            num_evaluated += 1
+        # entries no longer in the config
+        for entry_id, previous_entry in previous_entries.items():
+            if entry_id not in entries:
+                previous_data = previous_datas[entry_id]
+                removed_job_ids.extend([get_item_id(x) for x in previous_data['jobs']])
+                removed_result_ids.extend([get_item_id(x) for x in previous_data['results']])
+
+        # Publish the changes to the lists of jobs and results (see workflow_lists.py)
+        publish_workflow_list_delta('jobs', config_name, added_jobs, removed_job_ids)
+        publish_workflow_list_delta('results', config_name, added_results, removed_result_ids)
+        kc.set(_get_plan_key(config_name), {'entries': entries})
     print('-----------------------------')
-    # Print the jobs
+    # Print the jobs of the re-evaluated entries
     print('JOBS:')
-    for job in workflow.jobs:
-        if kc.get(job.key()) is None:
+    for job, settled in evaluated_jobs:
+        if not settled:
             a = '* '
         else:
             a = ''
         print(f'{a}{job.type}: {job.label}')
     print('-----------------------------')
-    # Print the results
-    print('RESULTS:')
-    for result in workflow.results:
+    # Print the new results
+    print('NEW RESULTS:')
+    for result in added_results:
         print(f'{result["sorter"]["name"]} {result["recording"]["studyName"]}/{result["recording"]["name"]}')
     print('-----------------------------')
+    print(f'Entries: {len(entries)} ({num_evaluated} re-evaluated)')
+    print(f'Jobs: {len(added_jobs)} added, {len(removed_job_ids)} removed')
+    print(f'Results: {len(added_results)} added, {len(removed_result_ids)} removed')
+    print('-----------------------------')
+
+def _add_recording_jobs(workflow: Workflow, sf_study_sets: dict, config_study: dict, recording_name: str, sorters0: List[dict]):
+    # load the recording dict from the spikeforest study sets
+    recording = get_spikeforest_recording(sf_study_sets, config_study['study_set_name'], config_study['study_name'], recording_name)
+    # prepare recording.nwb
+    recording_nwb_uri, preprocessing = _prepare_recording_nwb(workflow, recording)
+    # prepare sorting_true.npz
+    sorting_true_npz_uri = _prepare_sorting_true_npz(workflow, recording)
+
+    # sorting true metrics
+    sorting_true_metrics_uri = _sorting_metrics(workflow, recording, recording_nwb_uri, sorting_true_npz_uri)
+
+    recording_results: List[dict] = []
+    sortings: List[dict] = []
+    for sorter in sorters0: # for each sorter
+        # do the spike sorting for the given sorter
+        sorting_out = _sorting(workflow, recording, recording_nwb_uri, preprocessing, sorter)
+        if sorting_out is not None:
+            sorting_npz_uri = sorting_out['sorting_npz_uri']
+            sorting_console_lines_uri = sorting_out['console_lines_uri']
+        else:
+            sorting_npz_uri = None
+            sorting_console_lines_uri = None
+        if sorting_npz_uri is not None:
+            sortings.append({'name': sorter['name'], 'sorting_npz_uri': sorting_npz_uri})
+        # sorting figurl
+        sorting_figurl = _get_sorting_figurl(workflow, recording, sorter, recording_nwb_uri, sorting_npz_uri, sorting_console_lines_uri)
+        # compare with truth
+        comparison_uri = _compare_with_truth(workflow, recording, sorter, sorting_npz_uri, sorting_true_npz_uri)
+        if sorting_npz_uri is not None and comparison_uri is not None:
+            # if everything has completed for this recording/sorter, add the result to the workflow
+            recording_results.append({
+                'recording': recording,
+                'sorter': sorter,
+                'recording_nwb_uri': recording_nwb_uri,
+                'sorting_true_npz_uri': sorting_true_npz_uri,
+                'sorting_true_metrics_uri': sorting_true_metrics_uri,
+                'sorting_npz_uri': sorting_npz_uri,
+                'sorting_console_lines_uri': sorting_console_lines_uri,
+                'comparison_with_truth_uri': comparison_uri,
+                'sorting_figurl': sorting_figurl
+            })
+    # agreement between all the sorters (and truth) for this recording
+    sorter_agreement_uri = _compare_sorters(workflow, recording, sorting_true_npz_uri, sortings)
+    for result in recording_results:
+        result['sorter_agreement_uri'] = sorter_agreement_uri
+        workflow.add_result(result)
+
+def _diff_items(previous_items: List[dict], items: List[dict]):
+    previous_ids = set([get_item_id(x) for x in previous_items])
+    ids = set([get_item_id(x) for x in items])
+    added = [x for x in items if get_item_id(x) not in previous_ids]
+    removed = [id for id in previous_ids if id not in ids]
+    return added, removed
 
 def _prepare_recording_nwb(workflow: Workflow, recording: dict):
-    recording_label = f'{recording["studyName"]}/{recording["name"]}'
     job = Job(
         type='prepare-recording-nwb',
-        label=f'Prepare recording nwb: {recording_label}',
+        label=get_job_label('prepare-recording-nwb', recording),
         kwargs={
             'recording_uri': recording['recordingUri']
         },
         force_run=False
     )
     workflow.add_job(job)
-    output = kc.get(job.key())
-    recording_nwb_uri = output.get('recording_nwb_uri', None) if output is not None else None
-    recording_nwb_uri = recording_nwb_uri if recording_nwb_uri and kc.load_file(recording_nwb_uri, local_only=True) is not None else None
-    return recording_nwb_uri
+    output = workflow.get_output(job, ['recording_nwb_uri'])
+    recording_nwb_uri = output['recording_nwb_uri'] if output is not None else None
+    # outputs from before the preprocessing was recorded had the same preprocessing
+    preprocessing = output.get('preprocessing', recording_nwb_preprocessing) if output is not None else None
+    return recording_nwb_uri, preprocessing
 
 def _prepare_sorting_true_npz(workflow: Workflow, recording: dict):
-    recording_label = f'{recording["studyName"]}/{recording["name"]}'
     job = Job(
         type='prepare-sorting-true-npz',
-        label=f'Prepare sorting true npz: {recording_label}',
+        label=get_job_label('prepare-sorting-true-npz', recording),
         kwargs={
             'recording_uri': recording['recordingUri'],
             'sorting_true_uri': recording['sortingTrueUri']
@@ -134,18 +262,16 @@ def _prepare_sorting_true_npz(workflow: Workflow, recording: dict):
         force_run=False
     )
     workflow.add_job(job)
-    output = kc.get(job.key())
-    sorting_true_npz_uri = output.get('sorting_true_npz_uri', None) if output is not None else None
-    sorting_true_npz_uri = sorting_true_npz_uri if sorting_true_npz_uri and kc.load_file(sorting_true_npz_uri, local_only=True) is not None else None
+    output = workflow.get_output(job, ['sorting_true_npz_uri'])
+    sorting_true_npz_uri = output['sorting_true_npz_uri'] if output is not None else None
     return sorting_true_npz_uri
 
 def _sorting_metrics(workflow: Workflow, recording: dict, recording_nwb_uri: Union[str, None], sorting_npz_uri: Union[str, None]):
     if recording_nwb_uri is None: return None
     if sorting_npz_uri is None: return None
-    recording_label = f'{recording["studyName"]}/{recording["name"]}'
     job = Job(
         type='sorting-metrics',
-        label=f'Sorting true metrics: {recording_label}',
+        label=get_job_label('sorting-metrics', recording),
         kwargs={
             'recording_nwb_uri': recording_nwb_uri,
             'sorting_npz_uri': sorting_npz_uri
@@ -153,33 +279,48 @@ def _sorting_metrics(workflow: Workflow, recording: dict, recording_nwb_uri: Uni
         force_run=False
     )
     workflow.add_job(job)
-    output = kc.get(job.key())
-    sorting_metrics_uri = output.get('sorting_metrics_uri', None) if output is not None else None
-    sorting_metrics_uri = sorting_metrics_uri if sorting_metrics_uri and kc.load_file(sorting_metrics_uri, local_only=True) is not None else None
+    output = workflow.get_output(job, ['sorting_metrics_uri'])
+    sorting_metrics_uri = output['sorting_metrics_uri'] if output is not None else None
     return sorting_metrics_uri
 
-def _sorting(workflow: Workflow, recording: dict, recording_nwb_uri: Union[str, None], sorter: dict):
+def _get_effective_sorting_params(sorter: dict, preprocessing: List[dict]):
+    # The sorting params with the sorter's own preprocessing switched off for
+    # steps already applied to the recording, and whether the sorter should
+    # get a whitened copy of the recording instead of whitening it. The
+    # whitened copy is only used if the sorter would not filter before
+    # whitening.
+    algname = sorter['algorithm']
+    sorting_params = sorter['sorting_params']
+    if not sorter.get('skip_applied_preprocessing', True):
+        return sorting_params, False
+    sorting_params, _ = skip_applied_preprocessing(algname, sorting_params, preprocessing)
+    whiten_recording = sorter.get('reuse_whitened', False) and sorter_applies_step(algname, sorting_params, 'whiten') and not sorter_applies_step(algname, sorting_params, 'bandpass_filter')
+    if whiten_recording:
+        sorting_params, _ = skip_applied_preprocessing(algname, sorting_params, preprocessing + [{'type': 'whiten'}])
+    return sorting_params, whiten_recording
+
+def _sorting(workflow: Workflow, recording: dict, recording_nwb_uri: Union[str, None], preprocessing: Union[List[dict], None], sorter: dict):
     if recording_nwb_uri is None: return None
-    recording_label = f'{recording["studyName"]}/{recording["name"]}'
     sorter_name = sorter['name']
     algname = sorter['algorithm']
-    sorting_params = sorter['sorting_params']
+    sorting_params, whiten_recording = _get_effective_sorting_params(sorter, preprocessing)
+    kwargs = {
+        'algorithm': algname,
+        'recording_nwb_uri': recording_nwb_uri,
+        'sorting_params': sorting_params
+    }
+    if whiten_recording:
+        kwargs['whiten_recording'] = True
     job = Job(
         type='sorting',
-        label=f'{sorter_name} {recording_label}',
-        kwargs={
-            'algorithm': algname,
-            'recording_nwb_uri': recording_nwb_uri,
-            'sorting_params': sorting_params
-        },
+        label=get_job_label('sorting', recording, sorter_name),
+        kwargs=kwargs,
         force_run=False
     )
     workflow.add_job(job)
-    output = kc.get(job.key())
-    sorting_npz_uri = output.get('sorting_npz_uri', None) if output is not None else None
-    sorting_npz_uri = sorting_npz_uri if sorting_npz_uri and kc.load_file(sorting_npz_uri, local_only=True) is not None else None
-    console_lines_uri = output.get('console_lines_uri', None) if output is not None else None
-    console_lines_uri = console_lines_uri if console_lines_uri and kc.load_file(console_lines_uri, local_only=True) is not None else None
+    output = workflow.get_output(job, ['sorting_npz_uri', 'console_lines_uri'])
+    sorting_npz_uri = output['sorting_npz_uri'] if output is not None else None
+    console_lines_uri = output['console_lines_uri'] if output is not None else None
     return {
         'sorting_npz_uri': sorting_npz_uri,
         'console_lines_uri': console_lines_uri
@@ -188,11 +329,10 @@ def _sorting(workflow: Workflow, recording: dict, recording_nwb_uri: Union[str,
 def _compare_with_truth(workflow: Workflow, recording: dict, sorter: dict, sorting_npz_uri: Union[str, None], sorting_true_npz_uri: Union[str, None]):
     if sorting_npz_uri is None: return None
     if sorting_true_npz_uri is None: return None
-    recording_label = f'{recording["studyName"]}/{recording["name"]}'
     sorter_name = sorter['name']
     job = Job(
         type='compare-with-truth',
-        label=f'compare with truth {sorter_name} {recording_label}',
+        label=get_job_label('compare-with-truth', recording, sorter_name),
         kwargs={
             'sorting_npz_uri': sorting_npz_uri,
             'sorting_true_npz_uri': sorting_true_npz_uri
@@ -200,21 +340,37 @@ def _compare_with_truth(workflow: Workflow, recording: dict, sorter: dict, sorti
         force_run=False
     )
     workflow.add_job(job)
-    output = kc.get(job.key())
-    comparison_uri = output.get('comparison_uri', None) if output is not None else None
-    comparison_uri = comparison_uri if comparison_uri and kc.load_file(comparison_uri, local_only=True) is not None else None
+    output = workflow.get_output(job, ['comparison_uri'])
+    comparison_uri = output['comparison_uri'] if output is not None else None
     return comparison_uri
 
+def _compare_sorters(workflow: Workflow, recording: dict, sorting_true_npz_uri: Union[str, None], sortings: List[dict]):
+    if sorting_true_npz_uri is None: return None
+    if len(sortings) == 0: return None
+    job = Job(
+        type='compare-sorters',
+        label=get_job_label('compare-sorters', recording),
+        kwargs={
+            'sorting_true_npz_uri': sorting_true_npz_uri,
+            'sortings': sortings,
+            'delta_time_ms': 0.4
+        },
+        force_run=False
+    )
+    workflow.add_job(job)
+    output = workflow.get_output(job, ['sorter_agreement_uri'])
+    sorter_agreement_uri = output['sorter_agreement_uri'] if output is not None else None
+    return sorter_agreement_uri
+
 def _get_sorting_figurl(workflow: Workflow, recording: dict, sorter: dict, recording_nwb_uri: Union[str, None], sorting_npz_uri: Union[str, None], sorting_console_lines_uri: Union[str, None]):
     if sorting_npz_uri is None: return None
     if recording_nwb_uri is None: return None
-    recording_label = f'{recording["studyName"]}/{recording["name"]}'
     sorter_name = sorter['name']
     job = Job(
         type='sorting-figurl',
-        label=f'sorting figurl {sorter_name} {recording_label}',
+        label=get_job_label('sorting-figurl', recording, sorter_name),
         kwargs={
-            'label': f'{sorter_name} {recording_label}',
+            'label': get_job_label('sorting', recording, sorter_name),
             'recording_nwb_uri': recording_nwb_uri,
             'sorting_npz_uri': sorting_npz_uri,
             'sorting_console_lines_uri': sorting_console_lines_uri
@@ -222,11 +378,59 @@ def _get_sorting_figurl(workflow: Workflow, recording: dict, sorter: dict, recor
         force_run=False
     )
     workflow.add_job(job)
-    output = kc.get(job.key())
+    output = workflow.get_output(job, [])
     sorting_figurl = output.get('sorting_figurl', None) if output is not None else None
     return sorting_figurl
 
-def _get_spikeforest_recording(sf_study_sets: dict, study_set_name: str, study_name: str, recording_name: str):
+def get_recording_label(recording: dict):
+    return f'{recording["studyName"]}/{recording["name"]}'
+
+def get_job_label(job_type: str, recording: dict, sorter_name: Union[str, None]=None):
+    # job stats are recorded by label, so plan.py uses this too
+    recording_label = get_recording_label(recording)
+    if job_type == 'prepare-recording-nwb':
+        return f'Prepare recording nwb: {recording_label}'
+    elif job_type == 'prepare-sorting-true-npz':
+        return f'Prepare sorting true npz: {recording_label}'
+    elif job_type == 'sorting-metrics':
+        return f'Sorting true metrics: {recording_label}'
+    elif job_type == 'sorting':
+        return f'{sorter_name} {recording_label}'
+    elif job_type == 'sorting-figurl':
+        return f'sorting figurl {sorter_name} {recording_label}'
+    elif job_type == 'compare-with-truth':
+        return f'compare with truth {sorter_name} {recording_label}'
+    elif job_type == 'compare-sorters':
+        return f'compare sorters {recording_label}'
+    else:
+        raise Exception(f'Unexpected job type: {job_type}')
+
+def get_study_sorters(config_sorters: List[dict], config_study: dict):
+    sorters0: List[dict] = []
+    for sorter_name in config_study['sorter_names']:
+        x = [s for s in config_sorters if s['name'] == sorter_name]
+        if len(x) == 0:
+            raise Exception(f'Sorter not found in config: {sorter_name}')
+        assert len(x) == 1, f'Unexpected: duplicate sorter found in config: {sorter_name}'
+        sorters0.append(x[0])
+    return sorters0
+
+def get_config_entries(config: dict):
+    # The recordings of the config, each with the sorters to be run on it. A
+    # recording listed under several studies of the config gets the sorters
+    # of all of them.
+    entries: Dict[str, tuple] = {}
+    for config_study in config['studies']:
+        sorters0 = get_study_sorters(config['sorters'], config_study)
+        for recording_name in config_study['recording_names']:
+            entry_id = f'{config_study["study_set_name"]}/{config_study["study_name"]}/{recording_name}'
+            if entry_id not in entries:
+                entries[entry_id] = (entry_id, config_study, recording_name, [])
+            sorters1 = entries[entry_id][3]
+            sorters1.extend([s for s in sorters0 if s['name'] not in [s1['name'] for s1 in sorters1]])
+    return list(entries.values())
+
+def get_spikeforest_recording(sf_study_sets: dict, study_set_name: str, study_name: str, recording_name: str):
     try:
         study_set = [s for s in sf_study_sets['StudySets'] if s['name'] == study_set_name][0]
         study = [s for s in study_set['studies'] if s['name'] == study_name][0]
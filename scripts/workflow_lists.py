@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import uuid
+import socket
+import tempfile
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple, Union
+import kachery_client as kc
+from Job import Job
+from async_kachery import get_async_client
+
+# The job and result lists of a config, published by workflow.py as
+# versioned deltas. Each workflow run that changes a list writes one delta
+# (the items added and the ids of the items removed) and bumps the version;
+# every so often the full list is stored as a snapshot and the older deltas
+# are deleted. Readers keep a local copy of each list and only fetch the
+# deltas published since they last looked. Publishing (and the planning it
+# is based on) must hold publish_lock, since each delta is relative to the
+# previous plan.
+
+_snapshot_interval = 50
+_lock_poll_interval_sec = 5
+_lock_refresh_interval_sec = 60
+_stale_lock_sec = 600
+
+def get_item_id(item: dict) -> str:
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _get_version_key(list_type: str, config_name: str):
+    return {'type': f'spikeforest-workflow-{list_type}-version', 'name': config_name}
+
+def _get_delta_key(list_type: str, config_name: str, version: int):
+    return {'type': f'spikeforest-workflow-{list_type}-delta', 'name': config_name, 'version': version}
+
+def _get_cache_path(list_type: str, config_name: str):
+    cache_dir = os.environ.get('SPIKEFOREST_CACHE_DIR', os.path.expanduser('~/.cache/spikeforest'))
+    name_hash = hashlib.sha1(config_name.encode('utf-8')).hexdigest()
+    return f'{cache_dir}/workflow-{list_type}-{name_hash}.json'
+
+def _read_cache(list_type: str, config_name: str) -> Union[dict, None]:
+    path = _get_cache_path(list_type, config_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def _write_cache(list_type: str, config_name: str, x: dict):
+    path = _get_cache_path(list_type, config_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a unique temporary file, since several processes may update the cache
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(x, f)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def _apply_delta(items: List[Tuple[str, dict]], delta: dict):
+    removed = set(delta['removed'])
+    items = [(id, item) for id, item in items if id not in removed]
+    ids = set([id for id, _ in items])
+    for item in delta['added']:
+        id = get_item_id(item)
+        if id not in ids:
+            items.append((id, item))
+            ids.add(id)
+    return items
+
+def _update(list_type: str, config_name: str, version_record: Union[dict, None]):
+    # bring the local copy up to the published version
+    if version_record is None:
+        return {'epoch': None, 'version': 0, 'items': []}
+    cache = _read_cache(list_type, config_name)
+    changed = False
+    if cache is None or cache['epoch'] != version_record['epoch'] or cache['version'] > version_record['version'] or cache['version'] < version_record['snapshot_version']:
+        snapshot = kc.load_json(version_record['snapshot_uri']) if version_record['snapshot_uri'] is not None else []
+        assert snapshot is not None, f'Unable to load snapshot: {version_record["snapshot_uri"]}'
+        cache = {'epoch': version_record['epoch'], 'version': version_record['snapshot_version'], 'items': [(get_item_id(item), item) for item in snapshot]}
+        changed = True
+    items = [(id, item) for id, item in cache['items']]
+    versions = range(cache['version'] + 1, version_record['version'] + 1)
+    deltas = get_async_client().get_many([_get_delta_key(list_type, config_name, v) for v in versions])
+    for delta in deltas:
+        if delta is None:
+            return None
+        items = _apply_delta(items, delta)
+        changed = True
+    cache = {'epoch': cache['epoch'], 'version': version_record['version'], 'items': items}
+    if changed:
+        _write_cache(list_type, config_name, cache)
+    return cache
+
+def load_workflow_list(list_type: str, config_name: str) -> List[dict]:
+    for _ in range(2):
+        cache = _update(list_type, config_name, kc.get(_get_version_key(list_type, config_name)))
+        if cache is not None:
+            return [item for _, item in cache['items']]
+        # the deltas were deleted after a new snapshot: start again from the latest version
+    raise Exception(f'Unable to load workflow {list_type}: {config_name}')
+
+def publish_workflow_list_delta(list_type: str, config_name: str, added: List[dict], removed: List[str]):
+    if len(added) == 0 and len(removed) == 0:
+        return
+    version_key = _get_version_key(list_type, config_name)
+    version_record = kc.get(version_key)
+    if version_record is None:
+        version_record = {'epoch': str(uuid.uuid4()), 'version': 0, 'snapshot_version': 0, 'snapshot_uri': None}
+    version = version_record['version'] + 1
+    delta = {'added': added, 'removed': removed}
+    if not kc.set(_get_delta_key(list_type, config_name, version), delta, update=False):
+        raise Exception(f'Workflow {list_type} delta {version} was already published (is publish_lock held?): {config_name}')
+    new_version_record = dict(version_record, version=version)
+    if version - version_record['snapshot_version'] >= _snapshot_interval:
+        cache = _update(list_type, config_name, version_record)
+        assert cache is not None, f'Unable to load workflow {list_type}: {config_name}'
+        items = [item for _, item in _apply_delta(cache['items'], delta)]
+        new_version_record['snapshot_version'] = version
+        new_version_record['snapshot_uri'] = kc.store_json(items)
+    kc.set(version_key, new_version_record)
+    for v in range(version_record['snapshot_version'] + 1, new_version_record['snapshot_version'] + 1):
+        kc.delete(_get_delta_key(list_type, config_name, v))
+
+def _new_lock_record():
+    return {'host': socket.gethostname(), 'pid': os.getpid(), 'timestamp': time.time()}
+
+@contextmanager
+def publish_lock(config_name: str, timeout_sec: float=3600):
+    # A kachery mutable set with update=False. The holder refreshes the
+    # timestamp while it runs; a lock that was not refreshed for
+    # _stale_lock_sec is assumed to belong to a crashed run and is taken over.
+    key = {'type': 'spikeforest-workflow-publish-lock', 'name': config_name}
+    timer = time.time()
+    record = _new_lock_record()
+    while not kc.set(key, record, update=False):
+        x = kc.get(key)
+        if x is not None and time.time() - x['timestamp'] > _stale_lock_sec:
+            # only if it still holds the same stale record: another run may
+            # have taken it over already
+            if kc.get(key) == x:
+                print(f'Taking over stale workflow lock of process {x["pid"]} on {x["host"]}')
+                kc.delete(key)
+            record = _new_lock_record()
+            continue
+        if time.time() - timer > timeout_sec:
+            raise Exception(f'Timed out waiting for workflow lock: {config_name}')
+        print('Waiting for another workflow run to finish...')
+        time.sleep(_lock_poll_interval_sec)
+        record = _new_lock_record()
+    done = threading.Event()
+    def _refresh():
+        nonlocal record
+        while not done.wait(_lock_refresh_interval_sec):
+            if kc.get(key) != record:
+                print(f'Warning: lost workflow lock: {config_name}')
+                return
+            record = _new_lock_record()
+            kc.set(key, record)
+    thread = threading.Thread(target=_refresh, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+        if kc.get(key) == record:
+            kc.delete(key)
+
+def load_workflow_jobs(config_name: str) -> List[Job]:
+    return [Job.from_dict(x) for x in load_workflow_list('jobs', config_name)]
+
+def load_workflow_results(config_name: str) -> List[dict]:
+    return load_workflow_list('results', config_name)